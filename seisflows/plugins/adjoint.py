@@ -4,8 +4,9 @@ Functions used by the PREPROCESS class and specified by the MISFIT parameter
 import numpy as _np
 from scipy.signal import hilbert as _analytic
 
-from seisflows.plugins import misfit
+from seisflows.plugins import measure, misfit
 from seisflows.tools.math import hilbert as _hilbert
+from seisflows.tools.signal import cc_shift as _cc_shift
 
 
 def Waveform(syn, obs, nt, dt):
@@ -55,13 +56,13 @@ def InstantaneousPhase(syn, obs, nt, dt, eps=0.05):
     return wadj
 
 
-def Traveltime(syn, obs, nt, dt):
+def Traveltime(syn, obs, nt, dt, cc=None):
     # cross correlation traveltime
     # (Tromp et al 2005, eq 45)
     wadj = _np.zeros(nt)
     wadj[1:-1] = (syn[2:] - syn[0:-2])/(2.*dt)
     wadj *= 1./(sum(wadj*wadj)*dt)
-    wadj *= misfit.Traveltime(syn,obs,nt,dt)
+    wadj *= misfit.Traveltime(syn,obs,nt,dt,cc=cc)
     return wadj
 
 
@@ -74,10 +75,13 @@ def TraveltimeInexact(syn, obs, nt, dt):
     return wadj
 
 
-def Amplitude(syn, obs, nt, dt):
+def Amplitude(syn, obs, nt, dt, cc=None):
     # cross correlation amplitude
-    wadj = 1./(sum(syn*syn)*dt) * syn
-    wadj *= misfit.Amplitude(syn,obs,nt,dt)
+    energy = sum(syn*syn)
+    if energy == 0.:
+        return _np.zeros(nt)
+    wadj = 1./(energy*dt) * syn
+    wadj *= misfit.Amplitude(syn,obs,nt,dt,cc=cc)
     return wadj
 
 
@@ -89,16 +93,19 @@ def Envelope2(syn, obs, nt, dt, eps=0.):
     raise NotImplementedError
 
 
-def Envelope3(syn, obs, nt, dt, eps=0.):
+def Envelope3(syn, obs, nt, dt, eps=0., cc=None):
     # envelope lag
     # (Yuan et al 2015, eqs B-2, B-5)
     esyn = abs(_analytic(syn))
     eobs = abs(_analytic(obs))
 
+    if cc is None:
+        cc = _cc_shift(eobs, esyn, dt)
+
     erat = _np.zeros(nt)
     erat[1:-1] = (esyn[2:] - esyn[0:-2])/(2.*dt)
     erat[1:-1] /= esyn[1:-1]
-    erat *= misfit.Envelope3(syn, obs, nt, dt)
+    erat *= misfit.Envelope3(syn, obs, nt, dt, cc=cc)
 
     wadj = -erat*syn + _hilbert(erat*_hilbert(esyn))
     return wadj
@@ -122,6 +129,13 @@ def InstantaneousPhase2(syn, obs, nt, dt, eps=0.):
     return wadj
 
 
+def TraveltimeDD(syn, obs, nt, dt, pairs, fobs=None):
+    # double difference cross correlation traveltime
+    # (Yuan et al 2016, eq 13); acts on whole (nrec, nt) record sections, see
+    # plugins.measure.TraveltimeDD
+    return measure.TraveltimeDD(syn, obs, nt, dt, pairs, fobs)[1]
+
+
 
 ### migration
 
@@ -0,0 +1,286 @@
+"""
+Fused, batched misfit and adjoint source functions used by the PREPROCESS
+class and specified by the MISFIT parameter
+
+Each function returns both the residuals and the adjoint traces for synthetic
+and observed data, so that intermediate quantities such as analytic signals,
+envelopes and instantaneous phases are computed once per trace rather than
+once in the misfit and again in the adjoint function.
+
+All functions operate along the last axis, so they accept either single 1D
+traces or whole (nrec, nt) record sections, in which case Hilbert transforms,
+finite differences, normalizations and cross correlations are computed for
+all receivers with single NumPy/SciPy calls. Results are identical to those of
+the corresponding functions in seisflows.plugins.misfit and
+seisflows.plugins.adjoint, which preprocessing falls back to, one trace at a
+time, for misfits that are not defined here
+
+Misfits in ANALYTIC accept the analytic signal of the observed data as
+`aobs`, and those in the cross correlation family accept precomputed
+correlation measurements as `cc`, so that transforms of the observed data can
+be cached across evaluations, see seisflows.tools.signal.ObservedSpectra
+"""
+import numpy as _np
+from scipy.fft import next_fast_len as _next_fast_len
+from scipy.signal import hilbert as _analytic
+from scipy.sparse import csr_matrix as _csr_matrix
+
+from seisflows.tools.signal import cc_peak as _cc_peak
+from seisflows.tools.signal import cc_shift as _cc_shift
+
+
+# Misfits that accept the analytic signal of the observed data as `aobs`
+ANALYTIC = ["Envelope", "InstantaneousPhase", "InstantaneousPhase2"]
+
+# Misfits that compare pairs of receivers, and so require `pairs` and whole
+# record sections
+DOUBLE_DIFFERENCE = ["TraveltimeDD"]
+
+# Number of spectral samples correlated at once by double difference misfits
+_BLOCK_SIZE = 2**22
+
+
+def Waveform(syn, obs, nt, dt):
+    # waveform difference
+    # (Tromp et al 2005, eq 9)
+    wrsd = syn - obs
+    return _np.sqrt(_np.sum(wrsd*wrsd*dt, axis=-1)), wrsd
+
+
+def Envelope(syn, obs, nt, dt, eps=0.05, aobs=None):
+    # envelope difference
+    # (Yuan et al 2015, eqs 9, 16)
+    asyn = _analytic(syn, axis=-1)
+    esyn = abs(asyn)
+    eobs = abs(_analytic(obs, axis=-1) if aobs is None else aobs)
+
+    ersd = esyn - eobs
+    residual = _np.sqrt(_np.sum(ersd*ersd*dt, axis=-1))
+
+    etmp = ersd/(esyn + eps*esyn.max(axis=-1, keepdims=True))
+    wadj = etmp*syn - _np.imag(_analytic(etmp*_np.imag(asyn), axis=-1))
+
+    return residual, wadj
+
+
+def InstantaneousPhase(syn, obs, nt, dt, eps=0.05, aobs=None):
+    # instantaneous phase
+    # (Bozdag et al 2011, eq 27)
+    asyn = _analytic(syn, axis=-1)
+    if aobs is None:
+        aobs = _analytic(obs, axis=-1)
+
+    phi_syn = _np.arctan2(_np.imag(asyn), _np.real(asyn))
+    phi_obs = _np.arctan2(_np.imag(aobs), _np.real(aobs))
+
+    phi_rsd = phi_syn - phi_obs
+    residual = _np.sqrt(_np.sum(phi_rsd*phi_rsd*dt, axis=-1))
+
+    esyn = abs(asyn)
+    emax = _np.max(esyn**2., axis=-1, keepdims=True)
+
+    wadj = phi_rsd*_np.imag(asyn)/(esyn**2. + eps*emax) + \
+           _np.imag(_analytic(phi_rsd * syn/(esyn**2. + eps*emax), axis=-1))
+
+    return residual, wadj
+
+
+def Traveltime(syn, obs, nt, dt, cc=None):
+    # cross correlation traveltime
+    # (Tromp et al 2005, eq 45)
+    if cc is None:
+        cc = _cc_shift(obs, syn, dt)
+    residual, _ = cc
+
+    wadj = _velocity(syn, dt)
+    wadj *= 1./(_np.sum(wadj*wadj, axis=-1, keepdims=True)*dt)
+    wadj *= _expand(residual)
+
+    return residual, wadj
+
+
+def TraveltimeInexact(syn, obs, nt, dt):
+    # much faster but possibly inaccurate
+    residual = (_np.argmax(obs, axis=-1) - _np.argmax(syn, axis=-1))*dt
+
+    wadj = _velocity(syn, dt)
+    wadj *= 1./(_np.sum(wadj*wadj, axis=-1, keepdims=True)*dt)
+    wadj *= _expand(residual)
+
+    return residual, wadj
+
+
+def Amplitude(syn, obs, nt, dt, cc=None):
+    # cross correlation amplitude
+    # (Dahlen & Baig 2002; Tromp et al 2005, eq 61)
+    if cc is None:
+        cc = _cc_shift(obs, syn, dt)
+    _, ccmax = cc
+
+    # muted or empty traces have no amplitude to measure, and are given a zero
+    # residual and adjoint source rather than NaNs
+    energy = _np.sum(syn*syn, axis=-1)
+    valid = (energy > 0.) & (ccmax > 0.)
+    with _np.errstate(divide="ignore", invalid="ignore"):
+        residual = _np.where(valid, _np.log(energy/ccmax), 0.)
+        wadj = _np.where(_expand(valid), syn / (_expand(energy)*dt), 0.)
+    wadj *= _expand(residual)
+
+    return residual, wadj
+
+
+def Envelope3(syn, obs, nt, dt, eps=0., cc=None):
+    # envelope cross-correlation lag
+    # (Yuan et al 2015, eqs B-2, B-4, B-5)
+    asyn = _analytic(syn, axis=-1)
+    esyn = abs(asyn)
+
+    if cc is None:
+        eobs = abs(_analytic(obs, axis=-1))
+        cc = _cc_shift(eobs, esyn, dt)
+    residual, _ = cc
+
+    erat = _velocity(esyn, dt)
+    erat[..., 1:-1] /= esyn[..., 1:-1]
+    erat *= _expand(residual)
+
+    wadj = -erat*syn + _np.imag(
+        _analytic(erat*_np.imag(_analytic(esyn, axis=-1)), axis=-1))
+
+    return residual, wadj
+
+
+def InstantaneousPhase2(syn, obs, nt, dt, eps=0., aobs=None):
+    asyn = _analytic(syn, axis=-1)
+    if aobs is None:
+        aobs = _analytic(obs, axis=-1)
+    hsyn = _np.imag(asyn)
+    hobs = _np.imag(aobs)
+
+    esyn = abs(asyn)
+    eobs = abs(aobs)
+
+    esyn1 = esyn + eps*esyn.max(axis=-1, keepdims=True)
+    eobs1 = eobs + eps*eobs.max(axis=-1, keepdims=True)
+    esyn3 = esyn**3 + eps*_np.max(esyn**3, axis=-1, keepdims=True)
+
+    diff1 = syn/(esyn1) - obs/(eobs1)
+    diff2 = hsyn/esyn1 - hobs/eobs1
+
+    residual = _np.sqrt(_np.sum(diff1*diff1*dt, axis=-1))
+
+    part1 = diff1*hsyn**2/esyn3 - diff2*syn*hsyn/esyn3
+    part2 = diff1*syn*hsyn/esyn3 - diff2*syn**2/esyn3
+
+    wadj = part1 + _np.imag(_analytic(part2, axis=-1))
+
+    return residual, wadj
+
+
+def TraveltimeDD(syn, obs, nt, dt, pairs, fobs=None):
+    # double difference cross correlation traveltime
+    # (Yuan et al 2016, eqs 3, 13)
+    # residual of receiver pair (i, j) is the difference between synthetic
+    # and observed differential traveltimes; each pair contributes half of
+    # its squared residual to each of its receivers
+    nrec = syn.shape[0]
+    nfft = _next_fast_len(2 * nt - 1)
+    ii, jj = pairs[:, 0], pairs[:, 1]
+
+    fsyn = _np.fft.rfft(syn, nfft)
+    if fobs is None:
+        fobs = _np.fft.rfft(obs, nfft)
+
+    vsyn = _velocity(syn, dt)
+    fvel = _np.fft.rfft(vsyn, nfft)
+    omega = 2. * _np.pi * _np.fft.rfftfreq(nfft, dt)
+
+    # aligns circular correlations with the lags of signal.correlate
+    zero_lag = _np.exp(-1j * omega * (nt - 1) * dt)
+
+    ddt = _np.zeros(len(pairs))
+    wadj = _np.zeros(syn.shape)
+    nblock = max(1, _BLOCK_SIZE // len(omega))
+    for i0 in range(0, len(pairs), nblock):
+        i, j = ii[i0:i0 + nblock], jj[i0:i0 + nblock]
+
+        tsyn = _pair_lags(fsyn, i, j, nt, nfft, dt, zero_lag)
+        tobs = _pair_lags(fobs, i, j, nt, nfft, dt, zero_lag)
+        ddt[i0:i0 + nblock] = tsyn - tobs
+
+        # velocity of receiver j delayed, and of receiver i advanced, by the
+        # synthetic differential traveltime
+        shift = _np.exp(-1j * omega * tsyn[:, None])
+        vj = _np.fft.irfft(fvel[j] * shift, nfft)[:, :nt]
+        vi = _np.fft.irfft(fvel[i] * _np.conj(shift), nfft)[:, :nt]
+
+        norm = _np.sum(vsyn[i] * vj, axis=-1) * dt
+        with _np.errstate(divide="ignore", invalid="ignore"):
+            weight = _np.where(norm != 0., ddt[i0:i0 + nblock] / norm, 0.)
+
+        # scatter the pair contributions onto their receivers
+        npair = len(i)
+        scatter = _csr_matrix(
+            (_np.concatenate((-weight, weight)),
+             (_np.concatenate((i, j)), _np.arange(2 * npair))),
+            shape=(nrec, 2 * npair))
+        wadj += scatter @ _np.concatenate((vj, vi))
+
+    residual = _np.sqrt(0.5 * (_np.bincount(ii, ddt**2, minlength=nrec) +
+                               _np.bincount(jj, ddt**2, minlength=nrec)))
+
+    return residual, wadj
+
+
+def cross_correlate(misfit, syn, dt, spectra):
+    """
+    Cross correlation measurements shared between the misfit and adjoint
+    functions of the cross correlation family, here and in
+    seisflows.plugins.misfit and seisflows.plugins.adjoint, so that each
+    record section is only correlated once, in a single batched FFT pass
+
+    :type misfit: str
+    :param misfit: name of the misfit function, e.g. PAR.MISFIT
+    :type syn: np.array
+    :param syn: synthetic record section, shape (nrec, nt)
+    :type dt: float
+    :param dt: time step
+    :type spectra: seisflows.tools.signal.ObservedSpectra
+    :param spectra: cached transforms of the observed record section
+    :rtype: tuple of np.array or None
+    :return: (lag, ccmax) for each receiver, passed as `cc` to the misfit and
+        adjoint functions, or None if `misfit` is not cross correlation based
+    """
+    if misfit in ["Traveltime", "Amplitude"]:
+        return _cc_shift(spectra.data, syn, dt, spectra.fft)
+    elif misfit in ["Envelope3"]:
+        esyn = abs(_analytic(syn, axis=-1))
+        return _cc_shift(spectra.envelope, esyn, dt, spectra.envelope_fft)
+    else:
+        return None
+
+
+def _pair_lags(spectra, i, j, nt, nfft, dt, zero_lag):
+    """
+    Cross correlation traveltimes of traces i relative to traces j, from
+    their one-sided spectra padded to nfft, see signal.cc_shift
+    """
+    cc = _np.fft.irfft(spectra[i] * _np.conj(spectra[j]) * zero_lag, nfft)
+    return _cc_peak(cc[:, :2 * nt - 1], nt, dt)[0]
+
+
+def _velocity(w, dt):
+    """
+    Centered finite difference time derivative along the last axis, with the
+    first and last samples set to zero
+    """
+    v = _np.zeros(w.shape)
+    v[..., 1:-1] = (w[..., 2:] - w[..., 0:-2])/(2.*dt)
+    return v
+
+
+def _expand(residual):
+    """
+    Appends a trailing axis so that per-trace values broadcast against traces
+    """
+    return _np.asarray(residual)[..., None]
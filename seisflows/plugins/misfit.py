@@ -6,6 +6,9 @@
 import numpy as np
 from scipy.signal import hilbert as _analytic
 
+from seisflows.plugins import measure as _measure
+from seisflows.tools.signal import cc_shift as _cc_shift
+
 
 def Waveform(syn, obs, nt, dt):
     # waveform difference
@@ -38,9 +41,14 @@ def InstantaneousPhase(syn, obs, nt, dt, eps=0.05):
     return np.sqrt(np.sum(phi_rsd*phi_rsd*dt))
 
 
-def Traveltime(syn, obs, nt, dt):
-    cc = abs(np.convolve(obs, np.flipud(syn)))
-    return (np.argmax(cc)-nt+1)*dt
+def Traveltime(syn, obs, nt, dt, cc=None):
+    # cross correlation traveltime, positive if obs is delayed w.r.t. syn
+    # optional `cc` is a precomputed (lag, ccmax) from
+    # measure.cross_correlate()
+    if cc is None:
+        cc = _cc_shift(obs, syn, dt)
+    lag, _ = cc
+    return lag
 
 
 def TraveltimeInexact(syn, obs, nt, dt):
@@ -50,14 +58,18 @@ def TraveltimeInexact(syn, obs, nt, dt):
     return (jt-it)*dt
 
 
-def Amplitude(syn, obs, nt, dt):
-    # cross correlation amplitude
-    ioff = (np.argmax(cc)-nt+1)*dt
-    if ioff <= 0:
-        wrsd = syn[ioff:] - obs[:-ioff]
-    else:
-        wrsd = syn[:-ioff] - obs[ioff:]
-    return np.sqrt(np.sum(wrsd*wrsd*dt))
+def Amplitude(syn, obs, nt, dt, cc=None):
+    # cross correlation amplitude, log ratio of synthetic energy to the peak
+    # of the cross correlation with the observations
+    # (Dahlen & Baig 2002; Tromp et al 2005, eq 61)
+    # muted or empty traces have no amplitude to measure and a zero residual
+    if cc is None:
+        cc = _cc_shift(obs, syn, dt)
+    _, ccmax = cc
+    energy = np.sum(syn*syn, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where((energy > 0.) & (ccmax > 0.),
+                        np.log(energy/ccmax), 0.)
 
 
 def Envelope2(syn, obs, nt, dt, eps=0.):
@@ -68,12 +80,14 @@ def Envelope2(syn, obs, nt, dt, eps=0.):
     raise NotImplementedError
 
 
-def Envelope3(syn, obs, nt, dt, eps=0.):
+def Envelope3(syn, obs, nt, dt, eps=0., cc=None):
     # envelope cross-correlation lag
     # (Yuan et al 2015, eqs B-4)
-    esyn = abs(_analytic(syn))
-    eobs = abs(_analytic(obs))
-    return Traveltime(esyn, eobs, nt, dt)
+    if cc is None:
+        esyn = abs(_analytic(syn))
+        eobs = abs(_analytic(obs))
+        cc = _cc_shift(eobs, esyn, dt)
+    return Traveltime(syn, obs, nt, dt, cc=cc)
 
 
 def InstantaneousPhase2(syn, obs, nt, dt, eps=0.):
@@ -88,6 +102,13 @@ def InstantaneousPhase2(syn, obs, nt, dt, eps=0.):
     return np.sqrt(np.sum(diff*diff*dt))
 
 
+def TraveltimeDD(syn, obs, nt, dt, pairs, fobs=None):
+    # double difference cross correlation traveltime, per receiver
+    # (Yuan et al 2016); acts on whole (nrec, nt) record sections and an
+    # (npair, 2) array of receiver indices, see plugins.measure.TraveltimeDD
+    return _measure.TraveltimeDD(syn, obs, nt, dt, pairs, fobs)[0]
+
+
 
 def Displacement(syn, obs, nt, dt):
     return Exception('This function can only used for migration.')
@@ -97,4 +118,3 @@ def Velocity(syn, obs, nt, dt):
 
 def Acceleration(syn, obs, nt, dt):
     return Exception('This function can only used for migration.')
-
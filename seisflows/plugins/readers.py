@@ -6,55 +6,287 @@ introduce an additonal level of indirection
 Used by the PREPROCESS class and specified by the READER parameter
 """
 import os
+import numpy as np
+from glob import glob
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 
+from seisflows.tools import seismic_unix
 
-def su(path, filename):
+
+# Binary sidecar of an ASCII trace directory, see ascii()
+SIDECAR_TABLE = ".ascii_traces.npy"
+SIDECAR_INDEX = ".ascii_traces_index.npy"
+SIDECAR_GLOB = "*.sem*"
+SIDECAR_DTYPE = np.dtype([("filename", "S256"), ("size", "<i8"),
+                          ("mtime_ns", "<i8"), ("t0", "<f8"),
+                          ("delta", "<f8"), ("offset", "<i8"),
+                          ("npts", "<i8")])
+
+
+def su(path, filename, stream=True):
     """
-    Reads seismic unix files outputted by Specfem, using Obspy
+    Reads seismic unix files outputted by Specfem
+
+    The file is memory mapped rather than parsed by Obspy: trace data are
+    zero-copy (copy-on-write) rows of a single (nrec, nt) array and each
+    trace header is a record of a shared header array. Preprocessing works on
+    these arrays directly; callers that need Obspy get a Stream in which each
+    header is stored under stats.su.trace_header, as with Obspy, so that
+    attribute access is unchanged
 
     :type path: str
     :param path: path to datasets
     :type filename: str
     :param filename: file to read
+    :type stream: bool
+    :param stream: return an Obspy Stream, otherwise the arrays as a
+        seisflows.tools.seismic_unix.RecordSection without building a Trace
+        for every receiver
     """
-    from obspy import read
+    data, headers = seismic_unix.read(os.path.join(path, filename))
+
+    # Specfem writes a constant sample interval, in microseconds
+    delta = headers[0].sample_interval_in_ms_for_this_trace * 1E-6 \
+        if len(headers) else 1.
 
-    st = read(os.path.join(path, filename), format='SU', byteorder='<')
-    
-    return st
+    if not stream:
+        return seismic_unix.RecordSection(data, headers, delta)
 
+    from obspy.core import AttribDict, Stream, Trace
 
-def ascii(path, filenames):
+    traces = []
+    for ii in range(len(headers)):
+        traces.append(Trace(data=data[ii], header={
+            "delta": delta, "_format": "SU",
+            "su": AttribDict({"trace_header": headers[ii]})})
+        )
+
+    return Stream(traces=traces)
+
+
+def ascii(path, filename, sidecar=None):
     """
-    Reads SPECFEM3D-style ASCII data
+    Reads SPECFEM3D-style two-column (time, amplitude) ASCII data
+
+    Each file is parsed in a single vectorized call and multiple files are
+    parsed concurrently. Observed data never change during an inversion, so
+    the first time a directory named 'obs' is read, all of its SPECFEM traces
+    are parsed once and stored in a binary sidecar (a .npy array of the
+    concatenated samples plus a .npy index of filenames, file stats, time
+    axes and sample ranges) that later reads memory map instead of parsing
+    text. If requested traces are missing from the sidecar or have changed
+    since it was written, e.g. because data were regenerated, it is updated
 
     :type path: str
     :param path: path to datasets
-    :type filenames: list
-    :param filenames: files to read
+    :type filename: str or list
+    :param filename: file or files to read
+    :type sidecar: bool
+    :param sidecar: whether to use a binary sidecar for this directory; by
+        default only for observed data, i.e. a directory named 'obs'
     """
-    from numpy import loadtxt
     from obspy.core import Stream, Stats, Trace
 
+    filenames = [filename] if isinstance(filename, str) else list(filename)
+    if sidecar is None:
+        sidecar = os.path.basename(os.path.normpath(path)) == "obs"
+
+    # Rows of the sidecar for files that have not changed since it was written
+    rows = {}
+    if sidecar:
+        rows = _ascii_sidecar(path, filenames)
+
+    # Parse everything else from text
+    parse = [name for name in filenames if name not in rows]
+    for name, (t0, delta, data) in zip(
+            parse, _read_ascii_files([os.path.join(path, name)
+                                      for name in parse])):
+        rows[name] = (t0, delta, data)
+
     stream = Stream()
-    for filename in filenames:
-        stats = Stats()
-        data = loadtxt(os.path.join(path, filename))
+    for name in filenames:
+        t0, delta, data = rows[name]
 
-        stats.filename = filename
-        stats.starttime = data[0, 0]
-        stats.sampling_rate = data[0, 1] - data[0, 0]
-        stats.npts = len(data[:, 0])
+        stats = Stats()
+        stats.filename = name
+        stats.starttime = t0
+        stats.delta = delta
+        stats.npts = len(data)
 
         try:
-            parts = filename.split('.')
+            parts = name.split('.')
             stats.network = parts[0]
             stats.station = parts[1]
             stats.channel = parts[2]
         except:
             pass
 
-        stream.append(Trace(data=data[:, 1], header=stats))
+        stream.append(Trace(data=data, header=stats))
 
     return stream
 
+
+def _read_ascii(filename):
+    """
+    Parses a two-column ASCII trace in a single call
+
+    :type filename: str
+    :param filename: full path to the file
+    :rtype: tuple (float, float, np.ndarray)
+    :return: start time, sample interval and samples
+    """
+    with open(filename, "r") as f:
+        data = np.fromstring(f.read(), sep=" ").reshape(-1, 2)
+
+    # Averaged over the whole time axis, which is less sensitive to rounding
+    # of the printed times than the first time step
+    delta = (data[-1, 0] - data[0, 0]) / (len(data) - 1)
+
+    return data[0, 0], delta, data[:, 1]
+
+
+def _read_ascii_files(filenames):
+    """
+    Parses many ASCII traces concurrently, one file per thread
+
+    :type filenames: list
+    :param filenames: full paths to the files
+    :rtype: list
+    :return: (start time, sample interval, samples) for each file, in order
+    """
+    if len(filenames) < 2:
+        return [_read_ascii(filename) for filename in filenames]
+
+    with ThreadPoolExecutor(max_workers=min(len(filenames),
+                                            os.cpu_count() or 1)) as pool:
+        return list(pool.map(_read_ascii, filenames))
+
+
+def _ascii_stat(path, filename):
+    """
+    Size and modification time used to check that a file is unchanged
+    """
+    stat = os.stat(os.path.join(path, filename))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _ascii_sidecar(path, filenames):
+    """
+    Reads traces from the binary sidecar of an ASCII trace directory. The
+    sidecar holds all SPECFEM traces (*.sem*) in the directory. It is written
+    on first use, and rewritten whenever any of the requested traces is
+    missing from it or has changed since, so that traces added or regenerated
+    later are also read from binary. Unchanged traces are reused rather than
+    parsed again
+
+    :type path: str
+    :param path: path to datasets
+    :type filenames: list
+    :param filenames: names of the files to read
+    :rtype: dict
+    :return: (start time, sample interval, memory mapped samples) of the
+        files read from the sidecar, indexed by filename
+    """
+    index, table = _read_sidecar(path)
+    rows = _sidecar_rows(path, index, table, filenames)
+
+    stale = [name for name in filenames
+             if name not in rows and fnmatch(name, SIDECAR_GLOB)]
+    if stale or index is None:
+        index, table = _write_sidecar(path, index, table)
+        rows = _sidecar_rows(path, index, table, filenames)
+
+    return rows
+
+
+def _read_sidecar(path):
+    """
+    Reads the index and memory maps the samples of a sidecar written by
+    _write_sidecar
+
+    :type path: str
+    :param path: path to datasets
+    :rtype: tuple (np.ndarray, np.ndarray)
+    :return: index records and samples of all traces, or (None, None) if the
+        directory has no sidecar, or one written without sample ranges
+    """
+    index_file = os.path.join(path, SIDECAR_INDEX)
+    if not os.path.exists(index_file):
+        return None, None
+
+    index = np.load(index_file)
+    if index.dtype != SIDECAR_DTYPE:
+        return None, None
+
+    # Copy-on-write so that processing cannot alter the sidecar
+    return index, np.load(os.path.join(path, SIDECAR_TABLE), mmap_mode="c")
+
+
+def _sidecar_rows(path, index, table, filenames):
+    """
+    Looks up files in a sidecar, leaving out those that have changed since it
+    was written
+
+    :rtype: dict
+    :return: (start time, sample interval, samples) of the files found,
+        indexed by filename
+    """
+    if index is None:
+        return {}
+
+    rows = {}
+    lookup = {name.decode(): i for i, name in enumerate(index["filename"])}
+    for name in filenames:
+        i = lookup.get(name)
+        if i is not None and _ascii_stat(path, name) == \
+                (index["size"][i], index["mtime_ns"][i]):
+            offset = index["offset"][i]
+            rows[name] = (index["t0"][i], index["delta"][i],
+                          table[offset:offset + index["npts"][i]])
+    return rows
+
+
+def _write_sidecar(path, index=None, table=None):
+    """
+    Writes the binary sidecar of an ASCII trace directory from all SPECFEM
+    traces in the directory. Traces may differ in length, so their samples
+    are concatenated and the index records where each trace starts. A
+    directory without traces gets an empty sidecar
+
+    :type path: str
+    :param path: path to datasets
+    :type index: np.ndarray
+    :param index: optional index of a previous sidecar, whose unchanged
+        traces are reused rather than parsed
+    :type table: np.ndarray
+    :param table: samples of the previous sidecar
+    :rtype: tuple (np.ndarray, np.ndarray)
+    :return: index records and samples of all traces
+    """
+    filenames = sorted(os.path.basename(f) for f in
+                       glob(os.path.join(path, SIDECAR_GLOB)))
+
+    rows = _sidecar_rows(path, index, table, filenames)
+    parse = [name for name in filenames if name not in rows]
+    rows.update(zip(parse, _read_ascii_files([os.path.join(path, name)
+                                              for name in parse])))
+    traces = [rows[name] for name in filenames]
+
+    npts = [len(data) for _, _, data in traces]
+    offsets = np.cumsum([0] + npts[:-1])
+    index = np.array([(f, *_ascii_stat(path, f), t0, delta, offset, n)
+                      for f, (t0, delta, _), offset, n
+                      in zip(filenames, traces, offsets, npts)],
+                     dtype=SIDECAR_DTYPE)
+    table = np.concatenate([data for _, _, data in traces] or [[]])
+
+    # The index is written last as it marks the sidecar as complete
+    for filename, array in [(os.path.join(path, SIDECAR_TABLE), table),
+                            (os.path.join(path, SIDECAR_INDEX), index)]:
+        tmpfile = f"{filename}.{os.getpid()}.tmp"
+        with open(tmpfile, "wb") as f:
+            np.save(f, array)
+        os.replace(tmpfile, filename)
+
+    return index, table
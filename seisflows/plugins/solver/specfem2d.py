@@ -2,6 +2,7 @@
 """
 Plugins used for the numerical solver SPECFEM2D
 """
+import os
 import sys
 from seisflows.tools import array, unix
 from seisflows.tools.tools import exists, findpath
@@ -123,9 +124,18 @@ def smooth_legacy(input_path='', output_path='', parameters=[], span=0.):
 
     mesh = array.stack(coords['x'][0], coords['z'][0])
 
+    # triangulations are reused for as long as the mesh does not change,
+    # cached in scratch alongside the weights of the native smoother
+    cache = os.path.join(PATH.SCRATCH, 'smooth')
+    if not exists(cache):
+        unix.mkdir(cache)
+    interpolator = array.MeshInterpolator.cached(
+        mesh, os.path.join(cache, 'mesh_interpolator.npz'))
+
     # apply smoother
     for key in parameters or solver.parameters:
-        kernels[key] = [array.meshsmooth(kernels[key][0], mesh, span)]
+        kernels[key] = [array.meshsmooth(kernels[key][0], mesh, span,
+                                         interpolator=interpolator)]
 
     # write smooth kernels
     for key in parameters or solver.parameters:
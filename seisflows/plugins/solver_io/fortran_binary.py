@@ -25,6 +25,25 @@ def read_slice(path, parameters, iproc):
     return vals
 
 
+def map_slice(path, parameters, iproc):
+    """
+    Memory maps SPECFEM model slice(s) read-only, so that values are only
+    read from disk as they are accessed
+
+    :type path: str
+    :param path: path to the database files
+    :type parameters: str
+    :param parameters: parameters to read, e.g. 'vs', 'vp'
+    :type iproc: int
+    :param iproc: processor/slice number to read
+    """
+    vals = []
+    for key in iterable(parameters):
+        filename = os.path.join(path, f"proc{int(iproc):06d}_{key}.bin")
+        vals += [_mmap(filename)]
+    return vals
+
+
 def write_slice(data, path, parameters, iproc):
     """ 
     Writes SPECFEM model slice
@@ -81,6 +100,21 @@ def _read(filename):
             return data
 
 
+def _mmap(filename):
+    """
+    Memory maps Fortran style binary data as a read-only float32 array,
+    skipping the record markers if present, see _read
+    """
+    nbytes = os.path.getsize(filename)
+    n = np.fromfile(filename, dtype='int32', count=1)[0]
+
+    if n == nbytes-8:
+        return np.memmap(filename, dtype='float32', mode='r', offset=4,
+                         shape=(n // 4,))
+    else:
+        return np.memmap(filename, dtype='float32', mode='r')
+
+
 def _write(v, filename):
     """ 
     Writes Fortran style binary files
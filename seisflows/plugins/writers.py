@@ -7,19 +7,47 @@ Used by the PREPROCESS class and specified by the WRITER parameter
 """
 import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from seisflows.tools import seismic_unix
 
 
 def su(st, path, filename):
     """
-    Writes seismic unix files outputted by Specfem, using Obspy
+    Writes seismic unix files outputted by Specfem
 
-    :type st: obspy.core.stream.Stream
-    :param st: stream to write
+    Record sections and Streams read by readers.su carry their SU headers as
+    records, which are reused in bulk, e.g. synthetic headers for adjoint
+    traces; data are cast to float32 once for the whole stream. Other streams
+    are written by Obspy
+
+    :type st: obspy.core.stream.Stream or
+        seisflows.tools.seismic_unix.RecordSection
+    :param st: stream or record section to write
     :type path: str
     :param path: path to datasets
     :type filename: str
     :param filename: file to read
     """
+    _unlink(os.path.join(path, filename))
+
+    if isinstance(st, seismic_unix.RecordSection):
+        seismic_unix.write(os.path.join(path, filename), data=st.data,
+                           headers=st.headers, dt=st.delta)
+        return
+
+    headers = [getattr(tr.stats.get("su", {}), "trace_header", None)
+               for tr in st]
+
+    if all(isinstance(h, np.void) for h in headers):
+        seismic_unix.write(os.path.join(path, filename),
+                           data=np.array([tr.data for tr in st],
+                                         dtype=np.float32),
+                           headers=np.array(headers,
+                                            dtype=seismic_unix.HEADER_DTYPE),
+                           dt=st[0].stats.delta)
+        return
+
     for tr in st:
         # Work around obspy data type conversion
         tr.data = tr.data.astype(np.float32)
@@ -35,29 +63,42 @@ def su(st, path, filename):
     st.write(os.path.join(path, filename), format='SU')
 
 
-def ascii(st, path):
+def ascii(st, path, filename=None):
     """
-    Writes seismic traces as ascii files
+    Writes seismic traces as SPECFEM3D-style two-column ASCII files, one file
+    per trace named by stats.filename. Each file is formatted in a single
+    string operation and files are written concurrently
 
     :type st: obspy.core.stream.Stream
     :param st: stream to write
     :type path: str
     :param path: path to datasets
+    :type filename: str
+    :param filename: file to write if a single trace has no stats.filename
     """
-    for ir, tr in enumerate(st):
+    def write(tr):
         nt = tr.stats.npts
-        t1 = float(tr.stats.starttime)
-        t2 = t1 + tr.stats.npts * tr.stats.sampling_rate
+        t = float(tr.stats.starttime) + tr.stats.delta * np.arange(nt)
 
-        print(nt, t1, t2)
+        values = np.column_stack((t, tr.data)).ravel()
+        dst = os.path.join(path, tr.stats.get("filename", filename))
+        _unlink(dst)
+        with open(dst, "w") as f:
+            f.write(("%14.6f %18.8E\n" * nt) % tuple(values))
 
-        t = np.linspace(t1, t2, nt)
-        w = tr.data
+    with ThreadPoolExecutor(max_workers=min(len(st) or 1,
+                                            os.cpu_count() or 1)) as pool:
+        list(pool.map(write, st))
 
-        print(os.path.join(path, tr.stats.filename))
-        print(tr.times.shape, tr.data.shape)
 
-        np.savetxt(os.path.join(path, tr.stats.filename),
-                   np.column_stack((t, w))
-                   )
+def _unlink(filename):
+    """
+    Removes a symlink before it is written to, e.g. an adjoint trace file that
+    points at zero-valued traces shared with other files, so that the shared
+    file is replaced rather than written through
 
+    :type filename: str
+    :param filename: file about to be written
+    """
+    if os.path.islink(filename):
+        os.remove(filename)
@@ -2,9 +2,20 @@
 """
 This is the base class for the postprocess functionalities
 """
+import os
 import sys
+import fcntl
+import multiprocessing
+import numpy as np
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 
-from seisflows.tools.tools import exists
+from seisflows.plugins.solver_io import fortran_binary
+from seisflows.tools.smooth import GaussianSmoother
+from seisflows.tools.tools import cores, exists
+
+# Directory, within the kernel directory, of running sums of the kernels
+RUNNING_SUM = "running_sum"
 
 PAR = sys.modules['seisflows_parameters']
 PATH = sys.modules['seisflows_paths']
@@ -37,15 +48,28 @@ class Base:
         if "SMOOTH_V" not in PAR:
             setattr(PAR, "SMOOTH_V", 0.)
 
+        if "SMOOTH_NATIVE" not in PAR:
+            setattr(PAR, "SMOOTH_NATIVE", False)
+
+        if "ACCUMULATE_KERNELS" not in PAR:
+            setattr(PAR, "ACCUMULATE_KERNELS", False)
+
         if "TASKTIME_SMOOTH" not in PAR:
             setattr(PAR, "TASKTIME_SMOOTH", 1)
 
         if "MASK" not in PATH:
             setattr(PATH, "MASK", None)
 
+        if "SHARD_POSTPROCESS" not in PAR:
+            setattr(PAR, "SHARD_POSTPROCESS", False)
+
         if PATH.MASK:
             assert exists(PATH.MASK)
 
+        if PAR.SHARD_POSTPROCESS and PAR.SMOOTH_H > 0:
+            assert PAR.SMOOTH_NATIVE, \
+                "SHARD_POSTPROCESS requires SMOOTH_NATIVE for smoothing"
+
     def setup(self):
         """
         Placeholder for initialization or setup tasks
@@ -69,15 +93,208 @@ class Base:
 
         # If specified, smooth the kernels in the vertical and horizontal
         if PAR.SMOOTH_H > 0:
-            solver.combine(input_path=path, output_path=f"{path}/sum_nosmooth",
-                           parameters=parameters)
+            Base.combine_kernels(input_path=path,
+                                 output_path=f"{path}/sum_nosmooth",
+                                 parameters=parameters)
+
+            if PAR.SMOOTH_NATIVE:
+                Base.smoother().smooth(input_path=f"{path}/sum_nosmooth",
+                                       output_path=f"{path}/sum",
+                                       parameters=parameters, suffix="_kernel")
+            else:
+                solver.smooth(input_path=f"{path}/sum_nosmooth",
+                              output_path=f"{path}/sum", parameters=parameters,
+                              span_h=PAR.SMOOTH_H, span_v=PAR.SMOOTH_V)
+        else:
+            Base.combine_kernels(input_path=path, output_path=f"{path}/sum",
+                                 parameters=parameters)
 
-            solver.smooth(input_path=f"{path}/sum_nosmooth",
-                          output_path=f"{path}/sum", parameters=parameters,
-                          span_h=PAR.SMOOTH_H, span_v=PAR.SMOOTH_V)
+    @staticmethod
+    def combine_kernels_shard(path, parameters):
+        """
+        Sums the kernels of the shard of slices belonging to this task, see
+        Base.shard. Run through system.run if PAR.SHARD_POSTPROCESS
+
+        :type path: str
+        :param path: directory containing sensitivity kernels
+        :type parameters: list
+        :param parameters: material parameters e.g. ['vp','vs']
+        """
+        if PAR.SMOOTH_H > 0:
+            output_path = f"{path}/sum_nosmooth"
         else:
-            solver.combine(input_path=path, output_path=f"{path}/sum",
-                           parameters=parameters)
+            output_path = f"{path}/sum"
+
+        Base.combine_kernels(input_path=path, output_path=output_path,
+                             parameters=parameters,
+                             slices=Base.shard(solver.mesh_properties.nproc))
+
+    @staticmethod
+    def smooth_kernels_shard(path, parameters):
+        """
+        Smooths the summed kernels of the shard of slices belonging to this
+        task, reading the summed kernels of the shard and its halo. Must only
+        be run once all shards are summed, see Base.combine_kernels_shard
+
+        :type path: str
+        :param path: directory containing sensitivity kernels
+        :type parameters: list
+        :param parameters: material parameters e.g. ['vp','vs']
+        """
+        smoother = Base.smoother()
+        smoother.smooth(input_path=f"{path}/sum_nosmooth",
+                        output_path=f"{path}/sum", parameters=parameters,
+                        suffix="_kernel", slices=Base.shard(smoother.nslice))
+
+    @staticmethod
+    def gather_kernels(path, parameters):
+        """
+        Checks that the shards of all tasks have written their summed, and if
+        requested smoothed, kernels
+
+        :type path: str
+        :param path: directory containing sensitivity kernels
+        :type parameters: list
+        :param parameters: material parameters e.g. ['vp','vs']
+        """
+        missing = [f"proc{iproc:06d}_{par}_kernel.bin"
+                   for iproc in range(solver.mesh_properties.nproc)
+                   for par in parameters
+                   if not os.path.exists(os.path.join(
+                       path, "sum", f"proc{iproc:06d}_{par}_kernel.bin"))]
+        if missing:
+            raise FileNotFoundError(
+                f"{len(missing)} processed kernels missing from {path}/sum, "
+                f"e.g. {missing[0]}")
+
+    @staticmethod
+    def shard(nslice):
+        """
+        Slices to be processed by the current task, when postprocessing is
+        sharded over NTASK tasks. Slices are split into contiguous ranges
+        [a, b) of nearly equal size
+
+        :type nslice: int
+        :param nslice: number of slices in the mesh
+        :rtype: range
+        :return: slice numbers of the current task
+        """
+        taskid = system.taskid()
+        return range(nslice * taskid // PAR.NTASK,
+                     nslice * (taskid + 1) // PAR.NTASK)
+
+    @staticmethod
+    def smoother():
+        """
+        Gaussian smoother of the initial model's mesh, whose weights are
+        cached in the scratch directory for the whole inversion
+
+        :rtype: seisflows.tools.smooth.GaussianSmoother
+        :return: smoother for PAR.SMOOTH_H and PAR.SMOOTH_V
+        """
+        return GaussianSmoother(path=PATH.MODEL_INIT, span_h=PAR.SMOOTH_H,
+                                span_v=PAR.SMOOTH_V, nproc=PAR.NPROC,
+                                cache=os.path.join(PATH.SCRATCH, "smooth"))
+
+    @staticmethod
+    def combine_kernels(input_path, output_path, parameters, slices=None):
+        """
+        Sums kernels from individual sources, replacing one MPI launch of
+        SPECFEM's xcombine_sem per parameter. Does not require SPECFEM
+        binaries.
+
+        Kernels `<input_path>/<source>/procXXXXXX_<par>_kernel.bin` are memory
+        mapped and accumulated in double precision, one slice per worker
+        process. Sums are written as `<output_path>/procXXXXXX_<par>_kernel.bin`
+        in the same Fortran binary single precision format as xcombine_sem.
+        Sources already folded into running sums by accumulate_kernels are
+        not read again, unless their kernels have changed since
+
+        :type input_path: str
+        :param input_path: directory containing one kernel directory per source
+        :type output_path: str
+        :param output_path: directory to write the summed kernels to
+        :type parameters: list
+        :param parameters: material parameters e.g. ['vp','vs']
+        :type slices: list
+        :param slices: slice numbers to sum, defaults to all slices
+        """
+        os.makedirs(output_path, exist_ok=True)
+
+        # Slices are counted from the kernels of the first source
+        sources = [os.path.join(input_path, name)
+                   for name in solver.source_names]
+        if slices is None:
+            slices = range(len(glob(os.path.join(
+                sources[0], f"proc??????_{parameters[0]}_kernel.bin"))))
+
+        running_sum = os.path.join(input_path, RUNNING_SUM)
+        _map_slices(_combine_slice, [(sources, running_sum, output_path,
+                                      parameters, iproc)
+                                     for iproc in slices])
+
+    @staticmethod
+    def accumulate_kernels(path, source_name, parameters):
+        """
+        Folds the kernels of one source into running sums as soon as its
+        adjoint simulation finishes, so that by the time the last adjoint
+        simulation finishes, combine_kernels only has to convert the running
+        sums. Called by each eval_grad task if PAR.ACCUMULATE_KERNELS
+
+        Running sums are kept per slice in double precision in
+        `<path>/running_sum/procXXXXXX_sum.npz`, along with the names of the
+        sources they include and the sizes and modification times of their
+        kernel files. Concurrent tasks take turns updating each slice through
+        a file lock. A source that is already included, e.g. by a task that
+        is resubmitted, is not added again unless its kernels have since been
+        rewritten, in which case the running sum of the slice starts over
+
+        :type path: str
+        :param path: directory containing one kernel directory per source
+        :type source_name: str
+        :param source_name: name of the source whose kernels to add
+        :type parameters: list
+        :param parameters: material parameters e.g. ['vp','vs']
+        """
+        source = os.path.join(path, source_name)
+        running_sum = os.path.join(path, RUNNING_SUM)
+        os.makedirs(running_sum, exist_ok=True)
+
+        nslice = len(glob(os.path.join(
+            source, f"proc??????_{parameters[0]}_kernel.bin")))
+
+        # Tasks start at different slices to avoid waiting on each other
+        start = solver.source_names.index(source_name) % max(nslice, 1)
+        for iproc in np.roll(np.arange(nslice), -start):
+            filename = os.path.join(running_sum, f"proc{iproc:06d}_sum.npz")
+            with open(f"{filename}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    sums, stamps = _read_running_sum(filename)
+                    stamp = _kernel_stamp(source, parameters, iproc)
+                    if stamps.get(source_name) == stamp:
+                        continue
+
+                    # Kernels included earlier were rewritten, e.g. by
+                    # rerunning the evaluation, and cannot be subtracted
+                    if source_name in stamps:
+                        sums, stamps = {}, {}
+
+                    for par in parameters:
+                        kernel, = fortran_binary.map_slice(
+                            source, f"{par}_kernel", iproc)
+                        sums[par] = sums.get(par, 0.) + \
+                            kernel.astype("float64")
+                    stamps[source_name] = stamp
+
+                    tmp = f"{filename[:-4]}.{os.getpid()}.tmp.npz"
+                    np.savez(tmp, source_names=list(stamps),
+                             source_stamps=np.array(list(stamps.values()),
+                                                    dtype="int64"),
+                             **sums)
+                    os.replace(tmp, filename)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
 
     def write_gradient(self, path):
         """
@@ -102,41 +319,173 @@ class Base:
         if PAR.VERBOSE and PAR.SMOOTH_H > 0:
             print(f"\tSmoothing gradient: H={PAR.SMOOTH_H}, V={PAR.SMOOTH_V}")
 
-        system.run_single("postprocess", "process_kernels",
-                          path=f"{path}/kernels",
-                          scale_tasktime=PAR.TASKTIME_SMOOTH,
-                          parameters=solver.parameters)
+        if PAR.SHARD_POSTPROCESS:
+            # Each task sums, then smooths, a range of slices; smoothing
+            # reads neighboring slices so must wait for all sums
+            system.run("postprocess", "combine_kernels_shard",
+                       path=f"{path}/kernels", parameters=solver.parameters)
+            if PAR.SMOOTH_H > 0:
+                system.run("postprocess", "smooth_kernels_shard",
+                           path=f"{path}/kernels",
+                           parameters=solver.parameters)
+            self.gather_kernels(path=f"{path}/kernels",
+                                parameters=solver.parameters)
+        else:
+            system.run_single("postprocess", "process_kernels",
+                              path=f"{path}/kernels",
+                              scale_tasktime=PAR.TASKTIME_SMOOTH,
+                              parameters=solver.parameters)
+
+        if PATH.MASK and PAR.VERBOSE:
+            print(f"\tMasking gradient")
+
+        # Kernels, model and mask are streamed one slice at a time, rather
+        # than merged into full vectors
+        os.makedirs(f"{path}/gradient", exist_ok=True)
+        if PATH.MASK:
+            os.makedirs(f"{path}/gradient_nomask", exist_ok=True)
+
+        _map_slices(_gradient_slice,
+                    [(path, iproc)
+                     for iproc in range(solver.mesh_properties.nproc)])
+
+
+def _map_slices(func, tasks):
+    """
+    Applies func to the tasks of individual slices in a pool of up to NPROC
+    forked worker processes, which inherit the SeisFlows modules. Workers are
+    also limited to the cores allocated to this process, as this runs on the
+    master job for write_gradient
+
+    :type func: function
+    :param func: module level function to apply
+    :type tasks: list
+    :param tasks: arguments of func, one per slice
+    :rtype: list
+    :return: outputs of func, in the order of tasks
+    """
+    nproc = min(PAR.NPROC, len(tasks), cores())
+    if nproc > 1:
+        with ProcessPoolExecutor(
+                max_workers=nproc,
+                mp_context=multiprocessing.get_context("fork")) as pool:
+            return list(pool.map(func, tasks))
+    else:
+        return [func(args) for args in tasks]
+
 
-        # Access the gradient information stored in the kernel summation
-        gradient = solver.load(f"{path}/kernels/sum", suffix="_kernel")
+def _gradient_slice(args):
+    """
+    Writes one slice of the gradient, see Base.write_gradient
 
-        # Merge the gradients into a single vector
-        gradient = solver.merge(gradient)
+    :type args: tuple
+    :param args: (directory containing kernels and model, slice number)
+    """
+    path, iproc = args
+
+    for key in solver.parameters:
+        gradient, = solver.io.read_slice(f"{path}/kernels/sum",
+                                         f"{key}_kernel", iproc)
+        model, = solver.io.read_slice(f"{path}/model", key, iproc)
 
         # Convert to absolute perturbations:
         # log dm --> dm (see Eq.13 Tromp et al 2005)
-        gradient *= solver.merge(solver.load(f"{path}/model"))
+        gradient = gradient * np.asarray(model, dtype="float64")
 
         if PATH.MASK:
-            if PAR.VERBOSE:
-                print(f"\tMasking gradient")
             # to scale the gradient, users can supply "masks" by exactly
             # mimicking the file format in which models stored
-            mask = solver.merge(solver.load(PATH.MASK))
+            mask, = solver.io.read_slice(PATH.MASK, key, iproc)
 
             # While both masking and preconditioning involve scaling the
             # gradient, they are fundamentally different operations:
             # masking is ad hoc, preconditioning is a change of variables;
             # see Modrak & Tromp 2016 GJI
-            solver.save(solver.split(gradient), f"{path}/gradient_nomask",
-                        parameters=solver.parameters,
-                        suffix="_kernel")
+            solver.io.write_slice(gradient, f"{path}/gradient_nomask",
+                                  f"{key}_kernel", iproc)
+            gradient *= mask
 
-            solver.save(solver.split(gradient*mask), f"{path}/gradient",
-                        parameters=solver.parameters,
-                        suffix="_kernel")
-        else:
-            solver.save(solver.split(gradient), f"{path}/gradient",
-                        parameters=solver.parameters,
-                        suffix="_kernel")
+        solver.io.write_slice(gradient, f"{path}/gradient", f"{key}_kernel",
+                              iproc)
+
+
+def _read_running_sum(filename):
+    """
+    Reads the running sums of one slice written by Base.accumulate_kernels
+
+    :type filename: str
+    :param filename: .npz file of the running sums
+    :rtype: tuple (dict, dict)
+    :return: sums indexed by parameter, and the kernel stamps of the sources
+        included, indexed by source name, see _kernel_stamp
+    """
+    if not os.path.exists(filename):
+        return {}, {}
+
+    with np.load(filename) as f:
+        # Sums without kernel stamps cannot be checked, and start over
+        if "source_stamps" not in f.files:
+            return {}, {}
+        sums = {key: f[key] for key in f.files
+                if key not in ["source_names", "source_stamps"]}
+        stamps = dict(zip(f["source_names"].tolist(),
+                          f["source_stamps"].tolist()))
+
+    return sums, stamps
+
+
+def _kernel_stamp(source, parameters, iproc):
+    """
+    Sizes and modification times of the kernel files of one source and slice,
+    which tell whether the kernels in a running sum are still current
+
+    :type source: str
+    :param source: kernel directory of the source
+    :type parameters: list
+    :param parameters: material parameters e.g. ['vp','vs']
+    :type iproc: int
+    :param iproc: slice number
+    :rtype: list
+    :return: [size, mtime_ns] of the kernel file of each parameter
+    """
+    stamp = []
+    for par in parameters:
+        stat = os.stat(os.path.join(source,
+                                    f"proc{iproc:06d}_{par}_kernel.bin"))
+        stamp.append([stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+
+def _combine_slice(args):
+    """
+    Sums one slice of all parameters' kernels over sources, see
+    Base.combine_kernels. Module level so that it can be dispatched to a
+    process pool
+
+    :type args: tuple
+    :param args: (source kernel directories, running sum directory, output
+        directory, parameters, slice number)
+    """
+    sources, running_sum, output_path, parameters, iproc = args
+
+    sums, stamps = _read_running_sum(
+        os.path.join(running_sum, f"proc{iproc:06d}_sum.npz"))
+
+    # Running sums are only used if all the kernels in them are current
+    names = {os.path.basename(source): source for source in sources}
+    if any(name not in names or
+           stamp != _kernel_stamp(names[name], parameters, iproc)
+           for name, stamp in stamps.items()):
+        sums, stamps = {}, {}
+
+    for par in parameters:
+        total = sums.get(par)
+        for source in sources:
+            if os.path.basename(source) in stamps:
+                continue
+            kernel, = fortran_binary.map_slice(source, f"{par}_kernel", iproc)
+            if total is None:
+                total = np.zeros(kernel.shape, dtype="float64")
+            total += kernel
 
+        fortran_binary.write_slice(total, output_path, f"{par}_kernel", iproc)
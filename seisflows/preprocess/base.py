@@ -6,18 +6,34 @@ This is a main Seisflows class, it controls the preprocessing.
 """
 import os
 import sys
-import obspy
+import hashlib
+import functools
+import multiprocessing
 import numpy as np
+from glob import glob
+from obspy.signal.filter import bandpass, highpass, lowpass
+from scipy.signal import detrend
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
 
 from seisflows.tools import msg
 from seisflows.tools import signal
+from seisflows.tools.seismic_unix import RecordSection
 from seisflows.tools.err import ParameterError
-from seisflows.tools.tools import exists, getset
-from seisflows.plugins import adjoint, misfit, readers, writers
+from seisflows.tools.tools import getset, loadnpy, savenpy
+from seisflows.plugins import adjoint, measure, misfit, readers, writers
 
 PAR = sys.modules["seisflows_parameters"]
 PATH = sys.modules["seisflows_paths"]
 
+# Fields of the per-receiver records of the binary residuals file written by
+# each task, channel filenames are stored as bytes of the longest name
+RESIDUALS_FIELDS = [("receiver", "<i4"), ("residual", "<f8")]
+
+# Mute masks already built by this process, keyed by geometry and parameters.
+# Kept at module level so that they are not pickled along with the class
+_MUTE_MASKS = {}
+
 
 class Base:
     """
@@ -54,12 +70,24 @@ class Base:
         else:
             self.check_mute_parameters()
 
+        # Receiver pairs for double difference misfits
+        if PAR.MISFIT in measure.DOUBLE_DIFFERENCE:
+            if "DOUBLE_DIFFERENCE_MAX_DIST" not in PAR:
+                raise ParameterError(PAR, "DOUBLE_DIFFERENCE_MAX_DIST")
+            assert PAR.DOUBLE_DIFFERENCE_MAX_DIST > 0
+
         # Data filtering option using Obspy
         if "FILTER" not in PAR:
             setattr(PAR, "FILTER", None)
         else:
             self.check_filter_parameters()
 
+        # Measure misfit at a decimated rate, after filtering
+        if "DECIMATE" not in PAR:
+            setattr(PAR, "DECIMATE", None)
+        else:
+            self.check_decimate_parameters()
+
         # Assert that readers and writers available
         if PAR.FORMAT not in dir(readers):
             print(msg.ReaderError)
@@ -77,6 +105,8 @@ class Base:
         if PAR.MISFIT:
             self.misfit = getattr(misfit, PAR.MISFIT)
             self.adjoint = getattr(adjoint, PAR.MISFIT)
+            # Fused misfit and adjoint function, if one is available
+            self.measure = getattr(measure, PAR.MISFIT, None)
         elif PAR.BACKPROJECT:
             self.adjoint = getattr(adjoint, PAR.BACKPROJECT)
 
@@ -84,112 +114,402 @@ class Base:
         self.reader = getattr(readers, PAR.FORMAT)
         self.writer = getattr(writers, PAR.FORMAT)
 
+        # SU record sections are processed as whole arrays, without building
+        # an Obspy Trace for every receiver
+        if PAR.FORMAT.upper() == "SU":
+            self.reader = functools.partial(self.reader, stream=False)
+
     def prepare_eval_grad(self, path='./', **kwargs):
         """
         Prepares solver for gradient evaluation by writing residuals and
         adjoint traces
 
+        Note:
+            Channel files, and chunks of receivers within each channel file,
+            are processed concurrently on the PAR.NPROC cores allocated to the
+            task. Results are gathered in the order of `solver.data_filenames`
+            so that outputs are identical to a serial run.
+
         :type path: str
         :param path: directory containing observed and synthetic seismic data
         """
         # Need to load solver mid-workflow as preprocess is loaded first
         solver = sys.modules["seisflows_solver"]
+        filenames = solver.data_filenames
+
+        # Split each channel file into chunks of receivers so that all cores
+        # stay busy even when there are fewer channel files than cores
+        nchunk = self.get_chunk_count(nfiles=len(filenames))
+        chunks = [(path, filename, ichunk, nchunk)
+                  for filename in filenames for ichunk in range(nchunk)]
+
+        nproc = min(PAR.NPROC, len(chunks), os.cpu_count() or 1)
+        if nproc > 1:
+            # Forked workers inherit the SeisFlows modules in sys.modules
+            with ProcessPoolExecutor(
+                    max_workers=nproc,
+                    mp_context=multiprocessing.get_context("fork")) as pool:
+                results = list(pool.map(_process_chunk, chunks))
+        else:
+            results = [self.process_chunk(*chunk) for chunk in chunks]
+
+        # Gather chunks back into whole record sections, in order
+        residuals = {}
+        for i, filename in enumerate(filenames):
+            adj = None
+            for residuals_chunk, adj_chunk in \
+                    results[i * nchunk:(i + 1) * nchunk]:
+                if PAR.MISFIT:
+                    residuals.setdefault(filename, []).extend(residuals_chunk)
+                adj = adj_chunk if adj is None else adj + adj_chunk
 
-        for filename in solver.data_filenames:
-            obs = self.reader(os.path.join(path, "traces", "obs", filename))
-            syn = self.reader(os.path.join(path, "traces", "syn", filename))
+            # Write the adjoint traces
+            self.write_adjoint_traces(path=os.path.join(path, "traces", "adj"),
+                                      adj=adj, channel=filename)
 
-            # Process observations
-            obs = self.apply_filter(obs)
-            obs = self.apply_mute(obs)
-            obs = self.apply_normalize(obs)
+        if PAR.MISFIT:
+            self.write_residuals(path, residuals)
 
-            # Process synthetics
-            syn = self.apply_filter(syn)
-            syn = self.apply_mute(syn)
-            syn = self.apply_normalize(syn)
+    def process_chunk(self, path, filename, ichunk=0, nchunk=1):
+        """
+        Reads, processes and measures one chunk of receivers from a single
+        channel file. Run in parallel by prepare_eval_grad()
 
-            if PAR.MISFIT:
-                self.write_residuals(path, syn, obs)
+        :type path: str
+        :param path: directory containing observed and synthetic seismic data
+        :type filename: str
+        :param filename: channel file to process
+        :type ichunk: int
+        :param ichunk: index of the chunk of receivers to process
+        :type nchunk: int
+        :param nchunk: number of chunks the receivers are split into
+        :rtype: tuple (list or None, obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection)
+        :return: residuals (None if no misfit is defined) and adjoint traces
+            for the receivers in this chunk
+        """
+        syn = self.reader(path=os.path.join(path, "traces", "syn"),
+                          filename=filename)
+
+        # Select the receivers belonging to this chunk
+        bounds = np.linspace(0, len(syn), nchunk + 1).astype(int)
+        imin, imax = bounds[ichunk], bounds[ichunk + 1]
+        syn = syn[imin:imax]
+
+        # Processed observations and their transforms do not change between
+        # evaluations
+        spectra = self.get_observed(path, filename, imin, imax)
+
+        # Process synthetics
+        syn = self.apply_filter(syn)
+        syn = self.apply_mute(syn, path=os.path.join(path, "traces", "mute"))
+        syn = self.apply_normalize(syn)
+
+        residuals = None
+        if PAR.MISFIT:
+            residuals, adj = self.calculate_measurements(syn, spectra.data,
+                                                         spectra)
+        else:
+            adj = self.calculate_adjoint_traces(syn, spectra.data)
 
-            # Write the adjoint traces
-            self.write_adjoint_traces(path=os.path.join(path, "traces", "adj"),
-                                      syn=syn, obs=obs, channel=filename)
+        return residuals, adj
 
-    def write_residuals(self, path, syn, obs):
+    def get_observed(self, path, filename, imin=0, imax=None):
         """
-        Computes residuals
+        Returns filtered, muted and normalized observations for receivers
+        [imin, imax) of a channel file.
+
+        Observations and their processing parameters are fixed for the whole
+        inversion, so processed record sections are cached as memory-mappable
+        .npy files in `traces/obs_cache` and reused by later evaluations. The
+        cache key covers the observed file (size and modification time), the
+        receiver range and all filter, mute, normalization and time scheme
+        parameters, so a change to any of them causes reprocessing. Transforms
+        used by the misfit functions (spectra, analytic signals) are cached
+        next to the record section, see signal.ObservedSpectra
 
         :type path: str
-        :param path: location "adjoint traces" will be written
-        :type syn: obspy.core.stream.Stream
+        :param path: directory containing observed and synthetic seismic data
+        :type filename: str
+        :param filename: channel file to read
+        :type imin: int
+        :param imin: index of the first receiver
+        :type imax: int
+        :param imax: index after the last receiver, None for all receivers
+        :rtype: seisflows.tools.signal.ObservedSpectra
+        :return: processed observed data, shape (nrec, nt), as the `data`
+            attribute of their cached transforms
+        """
+        cache_path = os.path.join(path, "traces", "obs_cache")
+        prefix = f"{filename}_{imin}-{imax}"
+        key = self.get_observed_key(
+            os.path.join(path, "traces", "obs", filename))
+        cache = os.path.join(cache_path, f"{prefix}_{key}.npy")
+
+        if os.path.exists(cache):
+            # Copy-on-write so that misfit functions cannot alter the cache
+            return signal.ObservedSpectra(np.load(cache, mmap_mode="c"),
+                                          prefix=cache[:-len(".npy")])
+
+        obs = self.reader(path=os.path.join(path, "traces", "obs"),
+                          filename=filename)
+        obs = obs[imin:imax]
+
+        obs = self.apply_filter(obs)
+        obs = self.apply_mute(obs, path=os.path.join(path, "traces", "mute"))
+        obs = self.apply_normalize(obs)
+
+        data = signal.decimate(get_data(obs), self.get_decimation_factor())
+
+        # Replace any stale entry for this record section. Written to a
+        # temporary file first so a partially written cache is never read
+        os.makedirs(cache_path, exist_ok=True)
+        for stale in glob(os.path.join(cache_path, f"{prefix}_*.npy")):
+            os.remove(stale)
+        tmpfile = f"{cache}.{os.getpid()}.tmp"
+        with open(tmpfile, "wb") as f:
+            np.save(f, data)
+        os.replace(tmpfile, cache)
+
+        return signal.ObservedSpectra(data, prefix=cache[:-len(".npy")])
+
+    def get_observed_key(self, filename):
+        """
+        Hashes everything that determines a processed observed record section:
+        the observed data file and the processing parameters
+
+        :type filename: str
+        :param filename: full path to the observed data file
+        :rtype: str
+        :return: hexadecimal hash
+        """
+        stat = os.stat(filename)
+        keys = ["NT", "DT", "FILTER", "FREQ", "FREQMIN", "FREQMAX", "MUTE",
+                "MUTE_EARLY_ARRIVALS_SLOPE", "MUTE_EARLY_ARRIVALS_CONST",
+                "MUTE_LATE_ARRIVALS_SLOPE", "MUTE_LATE_ARRIVALS_CONST",
+                "MUTE_SHORT_OFFSETS_DIST", "MUTE_LONG_OFFSETS_DIST",
+                "NORMALIZE", "DECIMATE"]
+        pars = [(key, PAR[key] if key in PAR else None) for key in keys]
+
+        return hashlib.sha1(
+            repr((stat.st_size, stat.st_mtime_ns, pars)).encode()
+        ).hexdigest()
+
+    def get_chunk_count(self, nfiles):
+        """
+        Determines how many chunks of receivers each channel file is split
+        into so that there is at least one chunk for each available core.
+
+        Event normalization and double difference misfits require the entire
+        record section, in which case each channel file is processed as a
+        single chunk
+
+        :type nfiles: int
+        :param nfiles: number of channel files to be processed
+        :rtype: int
+        :return: number of receiver chunks per channel file
+        """
+        if getset(PAR.NORMALIZE) & {"NormalizeEventsL1", "NormalizeEventsL2"}:
+            return 1
+
+        if PAR.MISFIT in measure.DOUBLE_DIFFERENCE:
+            return 1
+
+        return max(1, int(np.ceil(PAR.NPROC / max(nfiles, 1))))
+
+    def calculate_measurements(self, syn, obs, spectra):
+        """
+        Computes residuals and "adjoint traces" for all receivers.
+
+        If seisflows.plugins.measure defines PAR.MISFIT, the whole record
+        section is measured with a single batched call on (nrec, nt) arrays,
+        which also shares intermediate quantities between the misfit and the
+        adjoint source. Otherwise falls back to calling the separate misfit
+        and adjoint functions one receiver at a time
+
+        :type syn: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
         :param syn: synthetic data
-        :type obs: obspy.core.stream.Stream
-        :param syn: observed data
+        :type obs: np.ndarray
+        :param obs: processed observed data, shape (nrec, nt), decimated
+            if DECIMATE is set
+        :type spectra: seisflows.tools.signal.ObservedSpectra
+        :param spectra: cached transforms of `obs`
+        :rtype: tuple (list, same type as `syn`)
+        :return: residuals for each receiver, and adjoint traces which reuse
+            the headers of `syn`
         """
         nt, dt, _ = self.get_time_scheme(syn)
         nn, _ = self.get_network_size(syn)
 
-        residuals = []
+        # Measure at the decimated rate of the observations
+        factor = self.get_decimation_factor()
+        syn_data = signal.decimate(get_data(syn), factor)
+        obs_data = obs
+        nt_full, nt, dt = nt, syn_data.shape[-1], dt * factor
+
+        # Cross correlation based misfits share one batched correlation of
+        # the record section between the misfit and adjoint functions
+        cc = measure.cross_correlate(PAR.MISFIT, syn_data, dt, spectra)
+
+        adj = syn
+        if self.measure is not None:
+            kwargs = {"cc": cc} if cc is not None else {}
+            if PAR.MISFIT in measure.ANALYTIC:
+                kwargs["aobs"] = spectra.analytic
+            if PAR.MISFIT in measure.DOUBLE_DIFFERENCE:
+                kwargs["pairs"] = self.get_receiver_pairs(syn)
+                kwargs["fobs"] = spectra.fft
+
+            residuals, wadj = self.measure(syn_data, obs_data, nt, dt,
+                                           **kwargs)
+            return list(residuals), set_data(
+                adj, signal.upsample(wadj, factor, nt_full))
+
+        residuals, wadj = [], []
         for ii in range(nn):
-            residuals.append(self.misfit(syn[ii].data, obs[ii].data, nt, dt))
+            kwargs = {"cc": (cc[0][ii], cc[1][ii])} if cc is not None else {}
+            residuals.append(self.misfit(syn_data[ii], obs_data[ii], nt, dt,
+                                         **kwargs))
+            wadj.append(signal.upsample(
+                self.adjoint(syn_data[ii], obs_data[ii], nt, dt, **kwargs),
+                factor, nt_full))
+
+        return residuals, set_data(adj, wadj)
 
-        filename = os.path.join(path, "residuals")
-        if exists(filename):
-            residuals.extend(list(np.loadtxt(filename)))
+    def write_residuals(self, path, residuals):
+        """
+        Writes the residuals of a task to a single binary file, with one
+        record per receiver holding the channel filename, receiver index and
+        residual (see residuals_dtype). Records are written in the order of
+        `solver.data_filenames`
+
+        :type path: str
+        :param path: location residuals will be written
+        :type residuals: dict
+        :param residuals: residuals for each receiver, keyed by channel
+            filename
+        """
+        nrec = sum(len(vals) for vals in residuals.values())
+        nchar = max([len(channel.encode()) for channel in residuals] or [1])
+        records = np.zeros(nrec, dtype=residuals_dtype(nchar))
 
-        np.savetxt(filename, residuals)
+        i = 0
+        for channel, vals in residuals.items():
+            records["channel"][i:i + len(vals)] = channel
+            records["receiver"][i:i + len(vals)] = np.arange(len(vals))
+            records["residual"][i:i + len(vals)] = vals
+            i += len(vals)
+
+        savenpy(os.path.join(path, "residuals"), records)
+
+    def read_residuals(self, files):
+        """
+        Reads residual records written by write_residuals() for any number of
+        tasks into one structured array
+
+        :type files: list
+        :param files: list of binary residual files, one per task
+        :rtype: np.ndarray
+        :return: concatenated records with fields 'channel', 'receiver' and
+            'residual'
+        """
+        if not files:
+            return np.zeros(0, dtype=residuals_dtype(1))
+
+        # Tasks store channel filenames with different lengths
+        records = [loadnpy(filename) for filename in files]
+        nchar = max(rec.dtype["channel"].itemsize for rec in records)
+        return np.concatenate([rec.astype(residuals_dtype(nchar))
+                               for rec in records])
 
     def sum_residuals(self, files):
         """
         Sums squares of residuals
 
         :type files: str
-        :param files: list of single-column text files containing residuals
+        :param files: list of binary residual files written by
+            write_residuals()
         :rtype: float
         :return: sum of squares of residuals
         """
-        total_misfit = 0.
-        for filename in files:
-            total_misfit += np.sum(np.loadtxt(filename) ** 2.)
+        return np.sum(self.read_residuals(files)["residual"] ** 2.)
+
+    def calculate_adjoint_traces(self, syn, obs):
+        """
+        Computes "adjoint traces" required for gradient computation, without
+        measuring residuals, e.g. for backprojection
+
+        :type syn: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
+        :param syn: synthetic data
+        :type obs: np.ndarray
+        :param obs: processed observed data, shape (nrec, nt), decimated
+            if DECIMATE is set
+        :rtype: same type as `syn`
+        :return: adjoint traces, which reuse the headers of `syn`
+        """
+        nt, dt, _ = self.get_time_scheme(syn)
+        nn, _ = self.get_network_size(syn)
 
-        return total_misfit
+        # Observations are stored at the decimated rate
+        factor = self.get_decimation_factor()
+        syn_data = signal.decimate(get_data(syn), factor)
 
-    def write_adjoint_traces(self, path, syn, obs, channel):
+        wadj = [signal.upsample(self.adjoint(syn_data[ii], obs[ii],
+                                             syn_data.shape[-1], dt * factor),
+                                factor, nt)
+                for ii in range(nn)]
+
+        return set_data(syn, wadj)
+
+    def write_adjoint_traces(self, path, adj, channel):
         """
         Writes "adjoint traces" required for gradient computation
 
         :type path: str
         :param path: location "adjoint traces" will be written
-        :type syn: obspy.core.stream.Stream
-        :param syn: synthetic data
-        :type obs: obspy.core.stream.Stream
-        :param syn: observed data
+        :type adj: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
+        :param adj: adjoint traces
         :type channel: str
         :param channel: channel or component code used by writer
         """
-        nt, dt, _ = self.get_time_scheme(syn)
-        nn, _ = self.get_network_size(syn)
-
-        adj = syn
-        for ii in range(nn):
-            adj[ii].data = self.adjoint(syn[ii].data, obs[ii].data, nt, dt)
-
         self.writer(adj, path, channel)
 
     def apply_filter(self, st):
         """
         Apply a filter using Obspy
 
-        :type st: obspy.core.stream.Stream
+        Record sections are filtered with single calls on the whole (nrec, nt)
+        array, with the same detrending, taper and zero-phase Butterworth
+        filters as the Stream methods used for other formats
+
+        :type st: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
         :param st: stream to be filtered
-        :rtype: obspy.core.stream.Stream
+        :rtype: same type as `st`
         :return: filtered traces
         """
         # If no filter given, don't do anything
         if PAR.FILTER is None:
             return st
 
+        if isinstance(st, RecordSection):
+            data = detrend(detrend(st.data, type="constant"), type="linear")
+            data = signal.taper(data, 0.05)
+
+            df = 1. / st.delta
+            if PAR.FILTER.upper() == "BANDPASS":
+                data = bandpass(data, PAR.FREQMIN, PAR.FREQMAX, df,
+                                zerophase=True)
+            elif PAR.FILTER.upper() == "LOWPASS":
+                data = lowpass(data, PAR.FREQ, df, zerophase=True)
+            elif PAR.FILTER.upper() == "HIGHPASS":
+                data = highpass(data, PAR.FREQ, df, zerophase=True)
+
+            return set_data(st, data)
+
         # Pre-processing before filtering
         st.detrend("demean")
         st.detrend("linear")
@@ -205,50 +525,96 @@ class Base:
 
         return st
 
-    def apply_mute(self, st):
+    def apply_mute(self, st, path=None):
         """
         Apply mute on data
 
-        :type st: obspy.core.stream.Stream
+        Source-receiver offsets are computed once for the record section, and
+        all requested mutes are combined into a single (nrec, nt) mask which
+        is applied with one multiplication. Masks are cached per acquisition
+        geometry, in memory and optionally on disk, since geometry does not
+        change between iterations
+
+        :type st: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
         :param st: stream to mute
-        :return:
+        :type path: str
+        :param path: optional directory in which to cache mute masks so that
+            they can be reused by later evaluations
+        :rtype: same type as `st`
+        :return: muted stream
         """
         if not PAR.MUTE:
             return st
 
-        if 'MuteEarlyArrivals' in PAR.MUTE:
-            traces = signal.mute_early_arrivals(
-                st,
-                PAR.MUTE_EARLY_ARRIVALS_SLOPE,  # (units: time/distance)
-                PAR.MUTE_EARLY_ARRIVALS_CONST,  # (units: time)
-                self.get_time_scheme(st),
-                self.get_source_coords(st),
-                self.get_receiver_coords(st))
-
-        if 'MuteLateArrivals' in PAR.MUTE:
-            traces = signal.mute_late_arrivals(
-                st,
-                PAR.MUTE_LATE_ARRIVALS_SLOPE,  # (units: time/distance)
-                PAR.MUTE_LATE_ARRIVALS_CONST,  # (units: time)
-                self.get_time_scheme(st),
-                self.get_source_coords(st),
-                self.get_receiver_coords(st))
+        mask = self.get_mute_mask(st, path=path)
 
-        if 'MuteShortOffsets' in PAR.MUTE:
-            traces = signal.mute_short_offsets(
-                st,
-                PAR.MUTE_SHORT_OFFSETS_DIST,
-                self.get_source_coords(st),
-                self.get_receiver_coords(st))
+        return set_data(st, get_data(st) * mask)
 
-        if 'MuteLongOffsets' in PAR.MUTE:
-            traces = signal.mute_long_offsets(
-                st,
-                PAR.MUTE_LONG_OFFSETS_DIST,
-                self.get_source_coords(st),
-                self.get_receiver_coords(st))
+    def get_mute_mask(self, st, path=None):
+        """
+        Returns the combined mute mask for a record section, building it only
+        if no mask exists yet for the same source and receiver geometry, time
+        scheme and mute parameters
 
-        return traces
+        :type st: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
+        :param st: stream to build the mute mask for
+        :type path: str
+        :param path: optional directory in which masks are cached as .npy
+            files, named by a hash of the geometry and mute parameters
+        :rtype: np.ndarray
+        :return: mask of shape (nrec, nt)
+        """
+        time_scheme = self.get_time_scheme(st)
+        s_coords = self.get_source_coords(st)
+        r_coords = self.get_receiver_coords(st)
+
+        mutes = {"early": None, "late": None, "short_dist": None,
+                 "long_dist": None}
+        if "MuteEarlyArrivals" in PAR.MUTE:
+            mutes["early"] = (PAR.MUTE_EARLY_ARRIVALS_SLOPE,  # (time/distance)
+                              PAR.MUTE_EARLY_ARRIVALS_CONST)  # (time)
+        if "MuteLateArrivals" in PAR.MUTE:
+            mutes["late"] = (PAR.MUTE_LATE_ARRIVALS_SLOPE,  # (time/distance)
+                             PAR.MUTE_LATE_ARRIVALS_CONST)  # (time)
+        if "MuteShortOffsets" in PAR.MUTE:
+            mutes["short_dist"] = PAR.MUTE_SHORT_OFFSETS_DIST
+        if "MuteLongOffsets" in PAR.MUTE:
+            mutes["long_dist"] = PAR.MUTE_LONG_OFFSETS_DIST
+
+        # Identify the mask by everything that determines it
+        key = hashlib.sha1(
+            np.array([s_coords[0], s_coords[1], r_coords[0], r_coords[1]],
+                     dtype=float).tobytes() +
+            repr((time_scheme, sorted(mutes.items()))).encode()
+        ).hexdigest()
+
+        if key in _MUTE_MASKS:
+            return _MUTE_MASKS[key]
+
+        filename = None
+        if path is not None:
+            filename = os.path.join(path, f"mute_{key}.npy")
+
+        if filename and os.path.exists(filename):
+            mask = np.load(filename, mmap_mode="r")
+        else:
+            mask = signal.mute_mask(offset=signal.offsets(s_coords, r_coords),
+                                    time_scheme=time_scheme, **mutes)
+            mask = mask.astype(np.float32)
+            if filename:
+                # Write to a temporary file first so that concurrent tasks
+                # never read a partially written mask
+                os.makedirs(path, exist_ok=True)
+                tmpfile = f"{filename}.{os.getpid()}.tmp"
+                with open(tmpfile, "wb") as f:
+                    np.save(f, mask)
+                os.replace(tmpfile, filename)
+
+        _MUTE_MASKS[key] = mask
+
+        return mask
 
     def apply_normalize(self, traces):
         """
@@ -259,37 +625,27 @@ class Base:
         if not PAR.NORMALIZE:
             return traces
 
+        data = get_data(traces)
+
         if 'NormalizeEventsL1' in PAR.NORMALIZE:
             # normalize event by L1 norm of all traces
-            w = 0.
-            for tr in traces:
-                w += np.linalg.norm(tr.data, ord=1)
-            for tr in traces:
-                tr.data /= w
+            data = data / np.sum(np.linalg.norm(data, ord=1, axis=-1))
 
         elif 'NormalizeEventsL2' in PAR.NORMALIZE:
             # normalize event by L2 norm of all traces
-            w = 0.
-            for tr in traces:
-                w += np.linalg.norm(tr.data, ord=2)
-            for tr in traces:
-                tr.data /= w
+            data = data / np.sum(np.linalg.norm(data, ord=2, axis=-1))
 
         if 'NormalizeTracesL1' in PAR.NORMALIZE:
             # normalize each trace by its L1 norm
-            for tr in traces:
-                w = np.linalg.norm(tr.data, ord=1)
-                if w > 0:
-                    tr.data /= w
+            w = np.linalg.norm(data, ord=1, axis=-1, keepdims=True)
+            data = data / np.where(w > 0, w, 1.)
 
         elif 'NormalizeTracesL2' in PAR.NORMALIZE:
             # normalize each trace by its L2 norm
-            for tr in traces:
-                w = np.linalg.norm(tr.data, ord=2)
-                if w > 0:
-                    tr.data /= w
+            w = np.linalg.norm(data, ord=2, axis=-1, keepdims=True)
+            data = data / np.where(w > 0, w, 1.)
 
-        return traces
+        return set_data(traces, data)
 
     def apply_filter_backwards(self, traces):
         """
@@ -346,6 +702,48 @@ class Base:
             assert PAR.FREQ > 0., "Freq must be > 0"
             assert PAR.FREQ < np.inf, "Freq > infinity"
 
+    def check_decimate_parameters(self):
+        """
+        Checks decimation settings. DECIMATE is either an integer factor, or
+        'auto' to derive the largest factor that keeps at least 10 samples per
+        period of the upper corner of a lowpass or bandpass filter, which
+        keeps the finite difference derivatives used by traveltime adjoint
+        sources accurate
+        """
+        if PAR.DECIMATE is None:
+            return
+
+        if isinstance(PAR.DECIMATE, str):
+            assert PAR.DECIMATE.upper() == "AUTO", \
+                "DECIMATE must be an integer factor, 'auto' or None"
+            assert PAR.FILTER and \
+                PAR.FILTER.upper() in ["BANDPASS", "LOWPASS"], \
+                "DECIMATE='auto' requires a lowpass or bandpass FILTER"
+        else:
+            assert int(PAR.DECIMATE) == PAR.DECIMATE and PAR.DECIMATE >= 1, \
+                "DECIMATE factor must be a positive integer"
+
+    def get_decimation_factor(self):
+        """
+        Integer factor by which filtered data are decimated before misfits
+        and adjoint sources are computed, see check_decimate_parameters
+
+        :rtype: int
+        :return: decimation factor, 1 if no decimation is applied
+        """
+        if not PAR.DECIMATE:
+            return 1
+
+        if isinstance(PAR.DECIMATE, str):
+            if PAR.FILTER.upper() == "BANDPASS":
+                freq = PAR.FREQMAX
+            else:
+                freq = PAR.FREQ
+            # Decimated time step <= 1 / (10 * corner frequency)
+            return max(1, int(np.floor(1. / (10. * freq * PAR.DT))))
+
+        return int(PAR.DECIMATE)
+
     def check_mute_parameters(self):
         """
         Checks mute settings, which are used to zero out early or late arrivals
@@ -415,11 +813,15 @@ class Base:
         """
         Retrieve the coordinates from a Stream object
 
-        :type st: obspy.core.stream.Stream
+        :type st: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
         :param st: a stream to query for coordinates
         :return:
         """
-        if PAR.FORMAT.upper == "SU":
+        if isinstance(st, RecordSection):
+            return (st.headers.group_coordinate_x,
+                    st.headers.group_coordinate_y, np.zeros(len(st)))
+        elif PAR.FORMAT.upper() == "SU":
             rx, ry, rz = [], [], []
 
             for tr in st:
@@ -430,15 +832,37 @@ class Base:
         else:
             raise NotImplementedError
 
+    def get_receiver_pairs(self, st):
+        """
+        Pairs of receivers closer than DOUBLE_DIFFERENCE_MAX_DIST, found with
+        a KD-tree so that the cost scales with the number of pairs rather than
+        the square of the number of receivers
+
+        :type st: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
+        :param st: a stream to query for coordinates
+        :rtype: np.ndarray
+        :return: receiver indices of each pair, shape (npair, 2), i < j
+        """
+        rx, ry, _ = self.get_receiver_coords(st)
+        tree = cKDTree(np.column_stack((rx, ry)))
+
+        return tree.query_pairs(r=PAR.DOUBLE_DIFFERENCE_MAX_DIST,
+                                output_type="ndarray")
+
     def get_source_coords(self, st):
         """
         Get the coordinates of the source object
 
-        :type st: obspy.core.stream.Stream
+        :type st: obspy.core.stream.Stream or
+            seisflows.tools.seismic_unix.RecordSection
         :param st: a stream to query for coordinates
         :return:
         """
-        if PAR.FORMAT.upper() == "SU":
+        if isinstance(st, RecordSection):
+            return (st.headers.source_coordinate_x,
+                    st.headers.source_coordinate_y, np.zeros(len(st)))
+        elif PAR.FORMAT.upper() == "SU":
             sx, sy, sz = [], [], []
             for tr in st:
                 sx += [tr.stats.su.trace_header.source_coordinate_x]
@@ -449,4 +873,63 @@ class Base:
             raise NotImplementedError
 
 
+def _process_chunk(args):
+    """
+    Module-level entry point for Base.process_chunk so that it can be
+    dispatched to a process pool; bound methods cannot be pickled, see
+    seisflows.config._pickle_method
+
+    :type args: tuple
+    :param args: positional arguments passed to Base.process_chunk
+    """
+    preprocess = sys.modules["seisflows_preprocess"]
+    return preprocess.process_chunk(*args)
 
+
+def get_data(traces):
+    """
+    Samples of a record section as a single array
+
+    :type traces: obspy.core.stream.Stream or
+        seisflows.tools.seismic_unix.RecordSection
+    :param traces: record section
+    :rtype: np.ndarray
+    :return: samples, shape (nrec, nt)
+    """
+    if isinstance(traces, RecordSection):
+        return traces.data
+    return np.array([tr.data for tr in traces])
+
+
+def set_data(traces, data):
+    """
+    Replaces the samples of a record section, keeping its headers
+
+    :type traces: obspy.core.stream.Stream or
+        seisflows.tools.seismic_unix.RecordSection
+    :param traces: record section
+    :type data: np.ndarray or list
+    :param data: new samples, one row per trace
+    :rtype: same type as `traces`
+    :return: `traces`, with the new samples
+    """
+    if isinstance(traces, RecordSection):
+        traces.data = np.asarray(data)
+    else:
+        for tr, row in zip(traces, data):
+            tr.data = row
+    return traces
+
+
+def residuals_dtype(nchar):
+    """
+    Record of one receiver in the binary residuals file, see
+    Base.write_residuals
+
+    :type nchar: int
+    :param nchar: number of bytes of the channel filename field, which must
+        hold the longest filename so that none are truncated
+    :rtype: np.dtype
+    :return: structured dtype with fields 'channel', 'receiver', 'residual'
+    """
+    return np.dtype([("channel", f"S{nchar}")] + RESIDUALS_FIELDS)
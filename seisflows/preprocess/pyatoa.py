@@ -11,17 +11,38 @@ misfit measurement.
 """
 import os
 import sys
+import h5py
+import shutil
 import pyatoa
+import threading
+import multiprocessing
 import numpy as np
 from glob import glob
+from pyasdf import ASDFDataSet
+from concurrent.futures import ProcessPoolExecutor
 from seisflows.tools import unix
 from seisflows.config import Dict
 from pyatoa.utils.images import merge_pdfs
+from pyatoa.utils.read import read_station_codes
 from seisflows.tools.err import ParameterError
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux ioctl that clones a file as copy-on-write (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
 PAR = sys.modules["seisflows_parameters"]
 PATH = sys.modules["seisflows_paths"]
 
+# State shared with forked workers by Pyatoa.process_parallel
+_PARALLEL = None
+
+# Location of the misfit windows of all evaluations in an ASDFDataSet
+WINDOWS = "AuxiliaryData/MisfitWindows"
+
 
 class Pyatoa:
     """
@@ -87,6 +108,9 @@ class Pyatoa:
         if "SNAPSHOT" not in PAR:
             setattr(PAR, "SNAPSHOT", True)
 
+        if "SNAPSHOT_BACKGROUND" not in PAR:
+            setattr(PAR, "SNAPSHOT_BACKGROUND", False)
+
         # Used to define the start time of fetched observation waveforms
         if "START_PAD" not in PAR:
             setattr(PAR, "START_PAD", 20)
@@ -141,8 +165,14 @@ class Pyatoa:
                                    sfpar=PAR, iteration=optimize.iter,
                                    step_count=optimize.line_search.step_count)
 
-        # Process all the stations for a given event using Pyaflowa
-        misfit = pyaflowa.process(source_name, fix_windows=PAR.FIX_WINDOWS)
+        # Process all the stations for a given event using Pyaflowa, split
+        # across the cores available to this task
+        nproc = min(PAR.NPROC, os.cpu_count() or 1)
+        if nproc > 1:
+            misfit = self.process_parallel(pyaflowa, source_name, nproc)
+        else:
+            misfit = pyaflowa.process(source_name,
+                                      fix_windows=PAR.FIX_WINDOWS)
 
         # Generate the necessary files to continue the inversion
         if misfit:
@@ -150,7 +180,79 @@ class Pyatoa:
             self.write_residuals(path=path, scaled_misfit=misfit,
                                  source_name=source_name)
         
-        self.snapshot()
+        self.snapshot(source_name=source_name)
+
+    def process_parallel(self, pyaflowa, source_name, nproc):
+        """
+        Processes the stations of an event in chunks on a local process pool.
+
+        Each worker processes its chunk of stations into its own partial
+        ASDFDataSet and writes adjoint sources for its stations. If windows
+        may be fixed, only the windows of previous evaluations are copied
+        into the partial datasets to look up. Partial datasets are then merged
+        into the event dataset, leaving out the copied windows, and the
+        workers' misfit and window counts are summed so that Pyaflowa can
+        finalize the event (STATIONS_ADJOINT, figures, logs) and scale the
+        misfit exactly as for serial processing
+
+        :type pyaflowa: pyatoa.Pyaflowa
+        :param pyaflowa: Pyaflowa instance for the current evaluation
+        :type source_name: str
+        :param source_name: the event id to be used for tagging and data lookup
+        :type nproc: int
+        :param nproc: maximum number of worker processes
+        :rtype: float
+        :return: scaled event misfit, see pyatoa.Pyaflowa.finalize
+        """
+        global _PARALLEL
+
+        # Cleans the dataset and writes the event and config for this event
+        io = pyaflowa.setup(source_name)
+        codes = read_station_codes(io.paths.stations_file, loc="*", cha="*")
+        bounds = np.linspace(0, len(codes),
+                             max(1, min(nproc, len(codes))) + 1).astype(int)
+        chunks = [codes[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+        # Fixed windows are read from previous evaluations, so workers need a
+        # copy of the windows as well as the event and config. Pyaflowa
+        # decides for which evaluations FIX_WINDOWS applies, so all previous
+        # windows are copied whenever it is set
+        fix_windows = bool(PAR.FIX_WINDOWS)
+        with ASDFDataSet(io.paths.ds_file) as ds:
+            event = ds.events[0]
+
+        previous = set()
+        if fix_windows:
+            with h5py.File(io.paths.ds_file, "r") as f:
+                if WINDOWS in f:
+                    previous.update(_datasets(f[WINDOWS]))
+
+        # Forked workers inherit the state, nothing needs to be pickled
+        _PARALLEL = (pyaflowa, io, chunks, event, fix_windows)
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=len(chunks),
+                    mp_context=multiprocessing.get_context("fork")) as pool:
+                results = list(pool.map(_process_stations,
+                                        range(len(chunks))))
+        finally:
+            _PARALLEL = None
+
+        # Merge the partial datasets and reduce the per-chunk counters
+        with h5py.File(io.paths.ds_file, "a") as dst:
+            for partial, counts in results:
+                with h5py.File(partial, "r") as src:
+                    _merge_groups(src, dst, skip=previous)
+                os.remove(partial)
+
+                for key in ["misfit", "nwin", "stations", "processed",
+                            "exceptions", "plot_fids"]:
+                    io[key] += counts[key]
+
+        # Keep plots in station order, as in serial processing
+        io.plot_fids = sorted(io.plot_fids)
+
+        return pyaflowa.finalize(io)
 
     def finalize(self):
         """
@@ -210,20 +312,73 @@ class Pyatoa:
 
         return total_misfit
 
-    def snapshot(self):
+    def snapshot(self, source_name=None):
         """
-        Copy all ASDFDataSets in the data directory into a separate snapshot
+        Copy ASDFDataSets in the data directory into a separate snapshot
         directory for redundancy
+
+        Only the dataset of the given source is copied, and only if its size
+        or modification time differ from the snapshot. Copies are reflinked
+        (copy-on-write clones) where the filesystem supports it, and written
+        to a temporary file first so that an interrupted copy never replaces
+        a good snapshot. Hard links are deliberately not used: datasets are
+        modified in place, so a hard-linked snapshot would share every later
+        write and provide no redundancy
+
+        :type source_name: str
+        :param source_name: event id of the dataset to snapshot, if None all
+            datasets are snapshotted
         """
-        if PAR.SNAPSHOT:
-            snapshot_dir = os.path.join(self.path_datasets, "snapshot")
-            if not os.path.exists(snapshot_dir):
-                unix.mkdir(snapshot_dir)
-            
+        if not PAR.SNAPSHOT:
+            return
+
+        snapshot_dir = os.path.join(self.path_datasets, "snapshot")
+        if not os.path.exists(snapshot_dir):
+            unix.mkdir(snapshot_dir)
+
+        if source_name is None:
             srcs = glob(os.path.join(self.path_datasets, "*.h5"))
-            for src in srcs:
-                dst = os.path.join(snapshot_dir, os.path.basename(src))
-                unix.cp(src, dst)
+        else:
+            srcs = glob(os.path.join(self.path_datasets, f"{source_name}.h5"))
+
+        if PAR.SNAPSHOT_BACKGROUND:
+            # Not a daemon, the interpreter waits for the copy before exiting
+            threading.Thread(target=self._snapshot,
+                             args=(srcs, snapshot_dir)).start()
+        else:
+            self._snapshot(srcs, snapshot_dir)
+
+    @staticmethod
+    def _snapshot(srcs, snapshot_dir):
+        """
+        Copies files into the snapshot directory, skipping unchanged ones
+
+        :type srcs: list
+        :param srcs: full paths to the files to snapshot
+        :type snapshot_dir: str
+        :param snapshot_dir: directory to copy the files into
+        """
+        for src in srcs:
+            dst = os.path.join(snapshot_dir, os.path.basename(src))
+
+            src_stat = os.stat(src)
+            if os.path.exists(dst):
+                dst_stat = os.stat(dst)
+                if (dst_stat.st_size, dst_stat.st_mtime_ns) == \
+                        (src_stat.st_size, src_stat.st_mtime_ns):
+                    continue
+
+            tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except (AttributeError, OSError):
+                    # No fcntl, or the filesystem cannot clone
+                    shutil.copyfileobj(fsrc, fdst)
+
+            # Keep the source times so that unchanged files can be skipped
+            os.utime(tmp, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            os.replace(tmp, dst)
 
     def make_final_pdfs(self):
         """
@@ -259,3 +414,115 @@ class Pyatoa:
             unix.rm(fids)
 
 
+def _process_stations(ichunk):
+    """
+    Worker for Pyatoa.process_parallel. Processes one chunk of stations into
+    a partial ASDFDataSet next to the event dataset. The event dataset holds
+    the waveforms of all previous evaluations, so rather than copying it,
+    only the previous windows are copied when windows are fixed
+
+    :type ichunk: int
+    :param ichunk: index of the chunk of stations to process
+    :rtype: tuple (str, dict)
+    :return: path to the partial dataset, and the worker's misfit, window,
+        station and figure counters
+    """
+    pyaflowa, io, chunks, event, fix_windows = _PARALLEL
+
+    partial = f"{io.paths.ds_file}.{ichunk:03d}.part"
+    with h5py.File(partial, "w") as dst:
+        if fix_windows:
+            with h5py.File(io.paths.ds_file, "r") as src:
+                if WINDOWS in src:
+                    src.copy(src[WINDOWS],
+                             dst.require_group(os.path.dirname(WINDOWS)))
+
+    # Counters restart from zero so that the parent can sum the chunks
+    for key in ["misfit", "nwin", "stations", "processed", "exceptions"]:
+        io[key] = 0
+    io.plot_fids = []
+
+    with ASDFDataSet(partial) as ds:
+        ds.add_quakeml(event)
+        io.config.write(write_to=ds)
+
+        mgmt = pyatoa.Manager(ds=ds, config=io.config)
+        for code in chunks[ichunk]:
+            _, io = pyaflowa.process_station(mgmt=mgmt, code=code, io=io,
+                                             fix_windows=PAR.FIX_WINDOWS)
+
+    return partial, {key: io[key] for key in ["misfit", "nwin", "stations",
+                                              "processed", "exceptions",
+                                              "plot_fids"]}
+
+
+def _merge_groups(src, dst, skip=()):
+    """
+    Recursively merges HDF5 groups and datasets from `src` into `dst`. Used to
+    merge partial ASDFDataSets, where each worker adds waveforms, windows and
+    adjoint sources for different stations. Datasets in `src` were written by
+    the current evaluation and replace any existing ones in `dst`, e.g. those
+    of an earlier attempt at the same evaluation
+
+    :type src: h5py.Group
+    :param src: group to copy from
+    :type dst: h5py.Group
+    :param dst: group to copy into
+    :type skip: set
+    :param skip: absolute names of datasets in `src` that are not merged, i.e.
+        the previous windows copied in by _process_stations
+    :raises TypeError: if a group in one file is a dataset in the other
+    """
+    for key, obj in src.items():
+        if key not in dst:
+            src.copy(obj, dst, name=key)
+        elif isinstance(obj, h5py.Group) != isinstance(dst[key], h5py.Group):
+            raise TypeError(f"Cannot merge {obj.name} of {src.file.filename} "
+                            f"into {dst.file.filename}, where it is a "
+                            f"{type(dst[key]).__name__}")
+        elif isinstance(obj, h5py.Group):
+            _merge_groups(obj, dst[key], skip)
+        elif obj.name not in skip:
+            _replace_dataset(obj, dst, key)
+
+
+def _replace_dataset(obj, dst, key):
+    """
+    Replaces dataset `key` of `dst` with the dataset `obj`. Data of the same
+    shape and type are overwritten in place, as HDF5 does not reuse the space
+    of deleted datasets and the dataset would otherwise grow on every merge
+
+    :type obj: h5py.Dataset
+    :param obj: dataset to copy
+    :type dst: h5py.Group
+    :param dst: group containing the dataset to replace
+    :type key: str
+    :param key: name of the dataset to replace
+    """
+    old = dst[key]
+    if old.shape == obj.shape and old.dtype == obj.dtype:
+        old[()] = obj[()]
+        old.attrs.clear()
+        old.attrs.update(obj.attrs)
+    else:
+        del dst[key]
+        obj.parent.copy(obj, dst, name=key)
+
+
+def _datasets(group):
+    """
+    Absolute names of all datasets within an HDF5 group
+
+    :type group: h5py.Group
+    :param group: group to search
+    :rtype: list
+    :return: names of datasets in the group and its subgroups
+    """
+    names = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            names.append(obj.name)
+
+    group.visititems(visit)
+    return names
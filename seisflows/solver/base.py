@@ -5,11 +5,12 @@ This class provides the core utilities for the Seisflows solver interactions
 """
 import os
 import sys
+import hashlib
 import numpy as np
 from glob import glob
 from functools import partial
 from seisflows.plugins import solver_io
-from seisflows.tools import msg, unix
+from seisflows.tools import msg, seismic_unix, unix, xdmf
 from seisflows.tools.err import ParameterError
 from seisflows.tools.seismic import Container, call_solver
 from seisflows.tools.tools import Struct, diff, exists
@@ -273,6 +274,12 @@ class Base:
         self.adjoint()
         self.export_kernels(path)
 
+        # Postprocess is registered after the solver, so is looked up here
+        if PAR.ACCUMULATE_KERNELS:
+            sys.modules["seisflows_postprocess"].accumulate_kernels(
+                path=os.path.join(path, "kernels"),
+                source_name=self.source_name, parameters=self.parameters)
+
         if export_traces:
             self.export_traces(path=os.path.join(path, "traces", "syn"),
                                prefix="traces/syn")
@@ -524,13 +531,42 @@ class Base:
         files = glob(os.path.join(output_path, "*"))
         unix.rename(old="_smooth", new="", names=files)
 
-    def combine_vol_data_vtk(self):
+    def combine_vol_data(self, input_path, output_path, parameters=None,
+                         suffix="", name="model", decimate=1,
+                         geometry_path=None):
         """
-        Postprocessing wrapper for xcombine_vol_data_vtk
+        Postprocessing: exports a model, gradient or kernels for visualization
+        as binary XDMF, a native replacement for xcombine_vol_data_vtk.
+        See seisflows.tools.xdmf
 
-        !!! must be implemented by subclass !!!
+        :type input_path: str
+        :param input_path: path to the slices to export
+        :type output_path: str
+        :param output_path: path to write the XDMF and raw files to
+        :type parameters: list
+        :param parameters: optional list of parameters,
+            defaults to `self.parameters`
+        :type suffix: str
+        :param suffix: optional filename suffix, eg '_kernel'
+        :type name: str
+        :param name: name of the XDMF file
+        :type decimate: int
+        :param decimate: export every `decimate`th GLL point
+        :type geometry_path: str
+        :param geometry_path: optional path to write the mesh coordinates to,
+            shared by exports of the same mesh so that they are written once,
+            defaults to `output_path`
+        :rtype: str
+        :return: path of the XDMF file
         """
-        pass
+        if parameters is None:
+            parameters = self.parameters
+
+        return xdmf.write(input_path=input_path, output_path=output_path,
+                          parameters=parameters,
+                          coords_path=self.mesh_properties.path,
+                          suffix=suffix, name=name, decimate=decimate,
+                          nproc=PAR.NPROC, geometry_path=geometry_path)
 
     def import_model(self, path):
         """
@@ -703,23 +739,83 @@ class Base:
             Adjoint traces are initialized by writing zeros for all channels.
             Channels actually in use during an inversion or migration will be
             overwritten with nonzero values later on.
+
+        Note:
+            Zeros are not derived from the observed data, only from their
+            geometry (SU trace headers, or the time axis of ASCII traces).
+            One zero file is written per geometry and every adjoint trace
+            file is a symlink to it, see `write_zero_traces`
         """
         if PAR.PREPROCESS == "base":
+            obs_path = os.path.join(self.cwd, "traces", "obs")
+            adj_path = os.path.join(self.cwd, "traces", "adj")
+            os.makedirs(adj_path, exist_ok=True)
+
             for filename in self.data_filenames:
-                d = preprocess.reader(
-                            path=os.path.join(self.cwd, "traces", "obs"),
-                            filename=filename
-                            )
-
-                # Set the data traces to zero
-                for t in d:
-                    t.data[:] = 0.
-
-                # Write traces
-                preprocess.writer(
-                         stream=d, path=os.path.join(self.cwd, "traces", "adj"),
-                         filename=filename
-                         )
+                zeros = self.write_zero_traces(
+                    src=os.path.join(obs_path, filename), path=adj_path)
+                self.link_adjoint_traces(
+                    src=zeros, dst=os.path.join(adj_path, filename))
+
+    def write_zero_traces(self, src, path):
+        """
+        Writes zero-valued traces with the geometry of a data file, unless a
+        file with the same geometry has already been written to `path`
+
+        :type src: str
+        :param src: data file to take trace headers or time axis from
+        :type path: str
+        :param path: directory to write the zero-valued traces to
+        :rtype: str
+        :return: full path to the zero-valued traces
+        """
+        if PAR.FORMAT.upper() == "SU":
+            # Only the trace headers of the memory map are touched
+            _, headers = seismic_unix.read(src)
+            headers = np.ascontiguousarray(headers)
+            key = hashlib.sha1(headers.tobytes()).hexdigest()
+        elif PAR.FORMAT.upper() == "ASCII":
+            with open(src, "r") as f:
+                t0 = float(f.readline().split()[0])
+            key = hashlib.sha1(repr((t0, PAR.NT, PAR.DT)).encode()).hexdigest()
+        else:
+            raise NotImplementedError(f"FORMAT {PAR.FORMAT}")
+
+        # Hidden so that the solvers' glob patterns never rename the file
+        zeros = os.path.join(path, f".zero_traces_{key}")
+        if not os.path.exists(zeros):
+            if PAR.FORMAT.upper() == "SU":
+                nt = headers[0]["number_of_samples_in_this_trace"]
+                seismic_unix.write(zeros, headers=headers,
+                                   data=np.zeros((len(headers), nt),
+                                                 dtype=np.float32))
+            else:
+                np.savetxt(zeros, np.column_stack(
+                    (t0 + PAR.DT * np.arange(PAR.NT), np.zeros(PAR.NT))),
+                    fmt="%14.6f %18.8E")
+
+        return zeros
+
+    def link_adjoint_traces(self, src, dst):
+        """
+        Points an adjoint trace file at the shared zero-valued traces behind
+        `src`, rather than copying them. Links are relative so that they
+        survive renaming within the adjoint trace directory, and writers
+        replace rather than write through them
+
+        :type src: str
+        :param src: zero-valued traces, or an adjoint trace file linked to them
+        :type dst: str
+        :param dst: adjoint trace file to create
+        """
+        if os.path.islink(src):
+            target = os.readlink(src)
+        else:
+            target = os.path.relpath(src, os.path.dirname(os.path.abspath(dst)))
+
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(target, dst)
 
     def check_mesh_properties(self, path=None):
         """
@@ -173,7 +173,7 @@ class Specfem2D(custom_import("solver", "base")):
                 src = f"U{PAR.CHANNELS[0]}_file_single.su.adj"
                 dst = f"{channel}s_file_single.su.adj"
                 if not exists(dst):
-                    unix.cp(src, dst)
+                    self.link_adjoint_traces(src, dst)
 
     def generate_mesh(self, model_path, model_name, model_type='gll'):
         """
@@ -211,7 +211,7 @@ class Specfem3D(custom_import("solver", "base")):
                     dst = f"{iproc:d}_d{channel}_SU.adj"
                     if not exists(dst):
                         src = f"{iproc:d}_d{PAR.COMPONENTS[0]}_SU.adj"
-                        unix.cp(src, dst)
+                        self.link_adjoint_traces(src, dst)
 
     def rename_data(self):
         """
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+This is a subclass seisflows.system.Multithreaded
+Provides utilities for running tasks concurrently on a single multi-core
+machine, such as a workstation running 2D inversions
+"""
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+from seisflows.tools import msg, unix
+from seisflows.tools.tools import nproc
+from seisflows.config import custom_import
+
+PAR = sys.modules["seisflows_parameters"]
+PATH = sys.modules["seisflows_paths"]
+
+
+class Multithreaded(custom_import("system", "serial")):
+    """
+    Run tasks concurrently on a single local machine, each task in its own
+    process on NPROC cores, with up to NPROCMAX cores in use at once
+    """
+    def check(self):
+        """
+        Checks parameters and paths
+        """
+        super().check()
+
+        # number of cores available to run tasks on
+        if "NPROCMAX" not in PAR:
+            setattr(PAR, "NPROCMAX", nproc())
+
+        # by default, tasks with more than one core run the solver with MPI
+        if not PAR.MPIEXEC and PAR.NPROC > 1:
+            setattr(PAR, "MPIEXEC", f"mpirun -n {PAR.NPROC}")
+
+        # optional environment variable list VAR1=val1,VAR2=val2,...
+        if "ENVIRONS" not in PAR:
+            setattr(PAR, "ENVIRONS", "")
+
+        assert PAR.NPROC <= PAR.NPROCMAX, \
+            f"NPROC ({PAR.NPROC}) exceeds available cores ({PAR.NPROCMAX})"
+
+    def run(self, classname, method, hosts="all", **kwargs):
+        """
+        Executes task NTASK times, running up to NPROCMAX // NPROC tasks at
+        once, each in a separate process
+        """
+        self.run_tasks(classname, method, range(PAR.NTASK), **kwargs)
+
+    def run_single(self, classname, method, *args, **kwargs):
+        """
+        Runs task a single time, in a separate process
+        """
+        self.run_tasks(classname, method, [0], **kwargs)
+
+    def run_tasks(self, classname, method, taskids, **kwargs):
+        """
+        Runs classname.method(**kwargs) once for each task id. Every task runs
+        in a forked process with its own SEISFLOWS_TASKID and environment, and
+        is bound to its own NPROC cores where supported. Output is written to
+        `output.logs/<classname>_<method>_<taskid>.log`. If a task fails, the
+        remaining tasks are stopped and the workflow exits
+
+        :type classname: str
+        :param classname: the class to run
+        :type method: str
+        :param method: the method from the given `classname` to run
+        :type taskids: list
+        :param taskids: task ids to run the method for
+        """
+        unix.mkdir(PATH.SYSTEM)
+        logs = os.path.join(PATH.WORKDIR, "output.logs")
+        os.makedirs(logs, exist_ok=True)
+
+        ctx = multiprocessing.get_context("fork")
+        nslot = max(1, min(PAR.NPROCMAX // PAR.NPROC, len(taskids)))
+        slots = list(range(nslot))
+        queue = list(taskids)
+        running = {}
+
+        try:
+            while queue or running:
+                # Fill free slots with queued tasks
+                while queue and slots:
+                    taskid, slot = queue.pop(0), slots.pop(0)
+                    if len(taskids) > 1:
+                        self.progress(taskid)
+                    log = os.path.join(
+                        logs, f"{classname}_{method}_{taskid:04d}.log")
+                    sys.stdout.flush()
+                    proc = ctx.Process(target=_run_task,
+                                       args=(classname, method, taskid, slot,
+                                             log, kwargs))
+                    proc.start()
+                    running[proc.sentinel] = (proc, taskid, slot, log)
+
+                # Wait for any task to finish
+                for sentinel in wait(list(running)):
+                    proc, taskid, slot, log = running.pop(sentinel)
+                    proc.join()
+                    if proc.exitcode != 0:
+                        print(msg.TaskError_Multithreaded.format(
+                            classname=classname, method=method,
+                            taskid=taskid, log=log))
+                        sys.exit(-1)
+                    slots.append(slot)
+        finally:
+            # Stop any tasks still running, e.g. after another task failed
+            for proc, *_ in running.values():
+                proc.terminate()
+            for proc, *_ in running.values():
+                proc.join()
+
+    def progress(self, taskid):
+        """
+        Provides status update by printing the current task being started
+        """
+        if PAR.NTASK > 1:
+            print(f"task {taskid + 1:02d} of {PAR.NTASK:02d} "
+                  f"[{time.strftime('%H:%M:%S')}]")
+
+
+def _run_task(classname, method, taskid, slot, log, kwargs):
+    """
+    Runs a single task in a forked worker process, see
+    Multithreaded.run_tasks. Output of the task, including that of any
+    subprocesses it calls, is redirected to the task's log file
+    """
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+
+    os.environ["SEISFLOWS_TASKID"] = str(taskid)
+    for item in PAR.ENVIRONS.strip(",").split(","):
+        if item:
+            os.environ.update([item.split("=", 1)])
+
+    # Bind the task to its own cores, which its MPI processes inherit
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        cores = cores[slot * PAR.NPROC:(slot + 1) * PAR.NPROC]
+        if cores:
+            os.sched_setaffinity(0, cores)
+
+    try:
+        func = getattr(sys.modules[f"seisflows_{classname}"], method)
+        func(**kwargs)
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
@@ -22,6 +22,10 @@ from seisflows.tools.err import ParameterError
 from seisflows.tools.tools import call, findpath
 from seisflows.config import custom_import
 
+# Shortest and longest intervals between job status queries, in seconds
+POLL_MIN = 5.
+POLL_MAX = 300.
+
 # Seisflows configuration
 PAR = sys.modules['seisflows_parameters']
 PATH = sys.modules['seisflows_paths']
@@ -131,12 +135,7 @@ class SlurmLg(custom_import('system', 'base')):
         jobs = self.job_id_list(stdout, PAR.NTASK)
 
         # Check job array completion status
-        while True:
-            # Wait a few seconds between queries
-            time.sleep(5)
-            isdone, jobs = self.job_array_status(classname, method, jobs)
-            if isdone:
-                return
+        self.wait_for_jobs(classname, method, jobs)
 
     def run_single(self, classname, method, *args, **kwargs):
         """
@@ -170,16 +169,35 @@ class SlurmLg(custom_import('system', 'base')):
 
         stdout = check_output(run_call, shell=True)
 
-        # Keep track of job ids
-        jobs = self.job_id_list(stdout, PAR.NTASK)
+        # Keep track of job ids, a single task runs as array element 0
+        jobs = self.job_id_list(stdout, 1)
 
         # Check job array completion status
+        self.wait_for_jobs(classname, method, jobs)
+
+    def wait_for_jobs(self, classname, method, jobs):
+        """
+        Polls the status of a job array until all of its jobs have completed.
+        The interval between polls starts at POLL_MIN seconds and doubles
+        after every poll, up to a tenth of the task time (bounded by POLL_MAX),
+        so that short tasks are picked up quickly while long tasks do not
+        overload the Slurm database
+
+        :type classname: str
+        :param classname: the class being run
+        :type method: str
+        :param method: the method from the given `classname` being run
+        :type jobs: list
+        :param jobs: list of jobs currently running
+        """
+        interval = POLL_MIN
+        interval_max = max(POLL_MIN, min(POLL_MAX, 60. * PAR.TASKTIME / 10.))
         while True:
-            # Wait a few seconds between queries
-            time.sleep(5)
+            time.sleep(interval)
             isdone, jobs = self.job_array_status(classname, method, jobs)
             if isdone:
                 return
+            interval = min(2 * interval, interval_max)
 
     def mpiexec(self):
         """
@@ -214,9 +232,11 @@ class SlurmLg(custom_import('system', 'base')):
         :type jobs: list
         :param jobs: list of jobs currently running
         """
+        job_states = self.job_states(jobs)
+
         states = []
         for job in jobs:
-            state = self.job_status(job)
+            state = job_states.get(job, "")
             if state in ['TIMEOUT']:
                 print(msg.TaskTimeout.format(classname=classname,
                                              method=method, job_id=job,
@@ -255,24 +275,40 @@ class SlurmLg(custom_import('system', 'base')):
         """
         Queries completion status of a single job
 
+        :type job: str
+        :param job: job id to query
+        :rtype: str
+        :return: state of the job, empty if not yet known to Slurm
+        """
+        return self.job_states([job]).get(job, "")
+
+    def job_states(self, jobs):
+        """
+        Queries completion status of many jobs, with a single sacct call for
+        all of the job arrays they belong to
+
             -L flag in sacct queries all available clusters, not just the
             cluster that ran the `sacct` call
+            -X flag only lists job allocations, not individual job steps
 
-        :type job: str
-        :param job: job id to query
+        :type jobs: list
+        :param jobs: job ids to query, e.g. ['1234_0', '1234_1']
+        :rtype: dict
+        :return: states indexed by job id, jobs unknown to Slurm, e.g.
+            pending array elements, are not included
         """
+        array_ids = sorted(set(job.split("_")[0] for job in jobs))
         stdout = check_output(
-            "sacct -nL -o jobid,state -j " + job.split("_")[0],
+            f"sacct -nLXP -o jobid,state -j {','.join(array_ids)}",
             shell=True)
 
         if isinstance(stdout, bytes):
             stdout = stdout.decode("UTF-8")
 
-        state = ""
-        lines = stdout.strip().split("\n")
-        for line in lines:
-            if line.split()[0] == job:
-                state = line.split()[1]
-        return state
-
-
+        # States may carry a reason, e.g. 'CANCELLED by 1000'
+        states = {}
+        for line in stdout.strip().split("\n"):
+            if "|" in line:
+                job_id, state = line.split("|")[:2]
+                states[job_id.strip()] = (state.split() or [""])[0]
+        return states
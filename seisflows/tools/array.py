@@ -5,10 +5,14 @@ These are tools useful for array manipulation in Seisflows
 import os
 
 import numpy as np
+import scipy.ndimage as _ndimage
 import scipy.signal as _signal
 import scipy.interpolate as _interp
+import scipy.sparse as _sparse
+import scipy.spatial as _spatial
 
-from seisflows.tools.math import gauss2
+# Gaussian filters longer than this are applied by FFT convolution
+FFT_FILTER_LENGTH = 64
 
 
 def count_zeros(a):
@@ -93,50 +97,81 @@ def stack(*args):
     return np.column_stack(args)
 
 
-def gridsmooth(Z, span):
+def gridsmooth(Z, span, weights=None):
     """
     Smooths values on 2D rectangular grid
 
+    The Gaussian is applied separably, one axis at a time, by direct
+    convolution for short filters and FFT convolution for long ones.
+    Smoothing is normalized by the smoothed weights, so that values outside
+    of the grid, or with zero weight, do not bias the result
+
     Note:
         'grid': set of structured coordinates,
         'mesh': set of unstructured coordinates
 
     :type Z: np.array
     :param Z: array to smooth
-    :type span: float
-    :param span: span to smooth along
+    :type span: float or tuple
+    :param span: half width of the Gaussian in grid points, which has a
+        standard deviation of span/2. A tuple gives (vertical, horizontal)
+        spans for the first and second axis of Z
+    :type weights: np.array
+    :param weights: optional weights of the values in Z, e.g. zero for masked
+        values
     :rtype: np.array
     :return: smoothed array
     """
-    import warnings
-    warnings.filterwarnings('ignore')
+    if weights is None:
+        weights = np.ones(Z.shape)
 
-    x = np.linspace(-2.*span, 2.*span, 2.*span + 1.)
-    y = np.linspace(-2.*span, 2.*span, 2.*span + 1.)
-    (X, Y) = np.meshgrid(x, y)
+    # Data and weights are smoothed together
+    ZW = np.stack((Z * weights, weights))
+    for axis, span_ in zip([1, 2], np.broadcast_to(span, 2)):
+        ZW = _gaussian_filter(ZW, span_, axis)
 
-    mu = np.array([0., 0.])
-    sigma = np.diag([span, span])**2.
-    
-    F = gauss2(X, Y, mu, sigma)
-    F = F/np.sum(F)
-    W = np.ones(Z.shape)
-    Z = _signal.convolve2d(Z, F, "same")
-    W = _signal.convolve2d(W, F, "same")
-    Z = Z/W
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return ZW[0] / ZW[1]
 
-    return Z
 
+def _gaussian_filter(a, span, axis):
+    """
+    Convolves an array along one axis with a Gaussian of standard deviation
+    span/2 grid points, truncated at span grid points, with zero padding
+    """
+    n = int(span)
+    if n < 1:
+        return a
 
-def meshsmooth(v, mesh, span):
+    x = np.arange(-n, n + 1)
+    f = np.exp(-0.5 * (2. * x / span) ** 2)
+    f /= f.sum()
+
+    if 2 * n + 1 <= FFT_FILTER_LENGTH:
+        return _ndimage.convolve1d(a, f, axis=axis, mode="constant")
+    else:
+        shape = [1] * a.ndim
+        shape[axis] = f.size
+        return _signal.fftconvolve(a, f.reshape(shape), mode="same",
+                                   axes=axis)
+
+
+def meshsmooth(v, mesh, span, interpolator=None):
     """
     Smooths values on 2D unstructured mesh
 
     Note:
         'grid': set of structured coordinates,
         'mesh': set of unstructured coordinates
+
+    :type interpolator: MeshInterpolator
+    :param interpolator: optional precomputed interpolator for the mesh, which
+        avoids triangulating the mesh and grid again
     """
-    V, grid = mesh2grid(v, mesh)
+    if interpolator is None:
+        interpolator = MeshInterpolator(mesh)
+
+    V = interpolator.mesh2grid(v)
     nz, nx = V.shape
     W = np.ones((nz, nx))
 
@@ -147,14 +182,12 @@ def meshsmooth(v, mesh, span):
         W[inan] = 0.
 
     # Apply smoother
-    V = gridsmooth(V, span)
-    W = gridsmooth(W, span)
-    V = V/W
+    V = gridsmooth(V, span, weights=W)
 
     if np.any(inan):
         V[inan] = 0.
 
-    vs = grid2mesh(V, grid, mesh)
+    vs = interpolator.grid2mesh(V)
     return vs
 
 
@@ -163,34 +196,8 @@ def mesh2grid(v, mesh):
     Interpolates from an unstructured coordinates (mesh) to a structured
     coordinates (grid)
     """
-    x = mesh[:,0]
-    z = mesh[:,1]
-    lx = x.max() - x.min()
-    lz = z.max() - z.min()
-    nn = v.size
-
-    nx = int(np.around(np.sqrt(nn*lx/lz)))
-    nz = int(np.around(np.sqrt(nn*lz/lx)))
-    dx = lx/nx
-    dz = lz/nz
-
-    # Construct structured grid
-    x = np.linspace(x.min(), x.max(), nx)
-    z = np.linspace(z.min(), z.max(), nz)
-    X, Z = np.meshgrid(x, z)
-    grid = stack(X.flatten(), Z.flatten())
-
-    # Interpolate to structured grid
-    V = _interp.griddata(mesh, v, grid, 'linear')
-
-    # Workaround edge issues
-    if np.any(np.isnan(V)):
-        W = _interp.griddata(mesh, v, grid, 'nearest')
-        for i in np.where(np.isnan(V)):
-            V[i] = W[i]
-
-    V = np.reshape(V, (nz, nx))
-    return V, grid
+    interpolator = MeshInterpolator(mesh)
+    return interpolator.mesh2grid(v), interpolator.grid
 
 
 def grid2mesh(V, grid, mesh):
@@ -200,3 +207,193 @@ def grid2mesh(V, grid, mesh):
     """
     return _interp.griddata(grid, V.flatten(), mesh, 'linear')
 
+
+class MeshInterpolator:
+    """
+    Linear interpolation between an unstructured 2D mesh and the structured
+    grid that mesh2grid defines for it
+
+    The mesh and grid are triangulated once, and the simplex vertices and
+    barycentric weights of every target point are stored in compact arrays,
+    so that transfers in either direction are sparse matrix-vector products.
+    Results are the same as those of scipy.interpolate.griddata, with grid
+    points outside of the convex hull of the mesh taking the value of the
+    nearest mesh point, as in mesh2grid
+    """
+    def __init__(self, mesh=None):
+        """
+        :type mesh: np.array
+        :param mesh: (n, 2) coordinates of the mesh, if None, attributes are
+            expected to be set by MeshInterpolator.load
+        """
+        self.mesh = None
+        self.shape = None
+        self.grid = None
+        self.mesh2grid_index = None
+        self.mesh2grid_weights = None
+        self.grid2mesh_index = None
+        self.grid2mesh_weights = None
+
+        self._mesh2grid = None
+        self._grid2mesh = None
+
+        if mesh is not None:
+            self.setup(mesh)
+
+    def setup(self, mesh):
+        """
+        Defines the structured grid and computes interpolation weights
+
+        :type mesh: np.array
+        :param mesh: (n, 2) coordinates of the mesh
+        """
+        self.mesh = np.asarray(mesh)
+        x = self.mesh[:, 0]
+        z = self.mesh[:, 1]
+        lx = x.max() - x.min()
+        lz = z.max() - z.min()
+        nn = len(self.mesh)
+
+        nx = int(np.around(np.sqrt(nn*lx/lz)))
+        nz = int(np.around(np.sqrt(nn*lz/lx)))
+
+        # Construct structured grid
+        x = np.linspace(x.min(), x.max(), nx)
+        z = np.linspace(z.min(), z.max(), nz)
+        X, Z = np.meshgrid(x, z)
+        self.shape = (nz, nx)
+        self.grid = stack(X.flatten(), Z.flatten())
+
+        # Points outside of the mesh take the value of the nearest mesh point
+        self.mesh2grid_index, self.mesh2grid_weights = \
+            self._barycentric(self.mesh, self.grid)
+        outside = self.mesh2grid_index[:, 0] < 0
+        if np.any(outside):
+            _, nearest = _spatial.cKDTree(self.mesh).query(self.grid[outside])
+            self.mesh2grid_index[outside] = nearest[:, None]
+            self.mesh2grid_weights[outside] = [1., 0., 0.]
+
+        # Points outside of the grid are NaN, as with griddata
+        self.grid2mesh_index, self.grid2mesh_weights = \
+            self._barycentric(self.grid, self.mesh)
+
+    def mesh2grid(self, v):
+        """
+        Interpolates values from the mesh to the grid
+
+        :type v: np.array
+        :param v: values on the mesh
+        :rtype: np.array
+        :return: (nz, nx) values on the grid
+        """
+        if self._mesh2grid is None:
+            self._mesh2grid = self._matrix(
+                self.mesh2grid_index, self.mesh2grid_weights, len(self.mesh))
+
+        return np.reshape(self._mesh2grid @ v, self.shape)
+
+    def grid2mesh(self, V):
+        """
+        Interpolates values from the grid to the mesh
+
+        :type V: np.array
+        :param V: (nz, nx) values on the grid
+        :rtype: np.array
+        :return: values on the mesh
+        """
+        if self._grid2mesh is None:
+            self._grid2mesh = self._matrix(
+                self.grid2mesh_index, self.grid2mesh_weights, len(self.grid))
+
+        v = self._grid2mesh @ V.flatten()
+        v[self.grid2mesh_index[:, 0] < 0] = np.nan
+        return v
+
+    def save(self, filename):
+        """
+        Saves the interpolator, so that it can be reused for the same mesh
+
+        :type filename: str
+        :param filename: .npz file to save to
+        """
+        tmp = f"{filename}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, mesh=self.mesh, shape=self.shape, grid=self.grid,
+                 mesh2grid_index=self.mesh2grid_index,
+                 mesh2grid_weights=self.mesh2grid_weights,
+                 grid2mesh_index=self.grid2mesh_index,
+                 grid2mesh_weights=self.grid2mesh_weights)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads an interpolator saved with MeshInterpolator.save
+
+        :type filename: str
+        :param filename: .npz file to load from
+        :rtype: MeshInterpolator
+        :return: interpolator
+        """
+        interpolator = cls()
+        with np.load(filename) as f:
+            for key in f.files:
+                setattr(interpolator, key, f[key])
+        interpolator.shape = tuple(int(n) for n in interpolator.shape)
+        return interpolator
+
+    @classmethod
+    def cached(cls, mesh, filename):
+        """
+        Loads the interpolator of a mesh from a file if it was saved for the
+        same mesh, otherwise computes it and tries to save it to the file
+
+        :type mesh: np.array
+        :param mesh: (n, 2) coordinates of the mesh
+        :type filename: str
+        :param filename: .npz file to load from or save to
+        :rtype: MeshInterpolator
+        :return: interpolator
+        """
+        if os.path.exists(filename):
+            interpolator = cls.load(filename)
+            if np.array_equal(interpolator.mesh, mesh):
+                return interpolator
+
+        interpolator = cls(mesh)
+        try:
+            interpolator.save(filename)
+        except OSError:
+            pass
+        return interpolator
+
+    @staticmethod
+    def _barycentric(points, targets):
+        """
+        Triangulates points and finds the simplex vertices and barycentric
+        weights of each target, vertices are -1 for targets outside of the
+        triangulation
+        """
+        tri = _spatial.Delaunay(points)
+        simplex = tri.find_simplex(targets)
+
+        index = tri.simplices[simplex].astype("int32")
+        transform = tri.transform[simplex]
+        b = np.einsum("ijk,ik->ij", transform[:, :2],
+                      targets - transform[:, 2])
+        weights = np.column_stack((b, 1. - b.sum(axis=1)))
+
+        index[simplex < 0] = -1
+        weights[simplex < 0] = 0.
+        return index, weights
+
+    @staticmethod
+    def _matrix(index, weights, n):
+        """
+        Sparse interpolation matrix from simplex vertices and weights
+        """
+        rows = np.repeat(np.arange(len(index)), index.shape[1])
+        inside = index.flatten() >= 0
+        return _sparse.csr_matrix(
+            (weights.flatten()[inside],
+             (rows[inside], index.flatten()[inside])),
+            shape=(len(index), n))
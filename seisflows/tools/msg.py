@@ -159,6 +159,19 @@ TASK ERROR
 
 """
 
+TaskError_Multithreaded = """
+
+TASK ERROR
+
+    Task failed:  {classname}.{method}
+    Task id:      {taskid}
+
+    For more information, see {log}
+
+    Stopping workflow...
+
+"""
+
 obspyImportError = """
 
 DEPENDENCY ERROR
@@ -0,0 +1,219 @@
+"""
+Functions to read and write Seismic Unix (SU) files that are outputted by
+Specfem, without going through ObsPy. Used by the SU reader and writer plugins
+
+An SU file is a sequence of traces, each of which is a 240 byte SEG-Y trace
+header followed by nt float32 samples. Files are memory mapped with a NumPy
+structured dtype, so that the samples of all traces are available as a single
+(nrec, nt) view and the headers as a record array, without building Python
+objects for every trace. Preprocessing keeps them together as a
+RecordSection rather than converting them to an ObsPy Stream
+"""
+import os
+import numpy as np
+
+
+# SEG-Y rev 1 trace header, field names follow obspy.io.segy
+HEADER_DTYPE = np.dtype([
+    ("trace_sequence_number_within_line", "<i4"),
+    ("trace_sequence_number_within_segy_file", "<i4"),
+    ("original_field_record_number", "<i4"),
+    ("trace_number_within_the_original_field_record", "<i4"),
+    ("energy_source_point_number", "<i4"),
+    ("ensemble_number", "<i4"),
+    ("trace_number_within_the_ensemble", "<i4"),
+    ("trace_identification_code", "<i2"),
+    ("number_of_vertically_summed_traces_yielding_this_trace", "<i2"),
+    ("number_of_horizontally_stacked_traces_yielding_this_trace", "<i2"),
+    ("data_use", "<i2"),
+    ("distance_from_center_of_the_source_point_to_the_center_of_the_"
+     "receiver_group", "<i4"),
+    ("receiver_group_elevation", "<i4"),
+    ("surface_elevation_at_source", "<i4"),
+    ("source_depth_below_surface", "<i4"),
+    ("datum_elevation_at_receiver_group", "<i4"),
+    ("datum_elevation_at_source", "<i4"),
+    ("water_depth_at_source", "<i4"),
+    ("water_depth_at_group", "<i4"),
+    ("scalar_to_be_applied_to_all_elevations_and_depths", "<i2"),
+    ("scalar_to_be_applied_to_all_coordinates", "<i2"),
+    ("source_coordinate_x", "<i4"),
+    ("source_coordinate_y", "<i4"),
+    ("group_coordinate_x", "<i4"),
+    ("group_coordinate_y", "<i4"),
+    ("coordinate_units", "<i2"),
+    ("weathering_velocity", "<i2"),
+    ("subweathering_velocity", "<i2"),
+    ("uphole_time_at_source_in_ms", "<i2"),
+    ("uphole_time_at_group_in_ms", "<i2"),
+    ("source_static_correction_in_ms", "<i2"),
+    ("group_static_correction_in_ms", "<i2"),
+    ("total_static_applied_in_ms", "<i2"),
+    ("lag_time_A", "<i2"),
+    ("lag_time_B", "<i2"),
+    ("delay_recording_time", "<i2"),
+    ("mute_time_start_time_in_ms", "<i2"),
+    ("mute_time_end_time_in_ms", "<i2"),
+    ("number_of_samples_in_this_trace", "<u2"),
+    ("sample_interval_in_ms_for_this_trace", "<u2"),
+    ("gain_type_of_field_instruments", "<i2"),
+    ("instrument_gain_constant", "<i2"),
+    ("instrument_early_or_initial_gain", "<i2"),
+    ("correlated", "<i2"),
+    ("sweep_frequency_at_start", "<i2"),
+    ("sweep_frequency_at_end", "<i2"),
+    ("sweep_length_in_ms", "<i2"),
+    ("sweep_type", "<i2"),
+    ("sweep_trace_taper_length_at_start_in_ms", "<i2"),
+    ("sweep_trace_taper_length_at_end_in_ms", "<i2"),
+    ("taper_type", "<i2"),
+    ("alias_filter_frequency", "<i2"),
+    ("alias_filter_slope", "<i2"),
+    ("notch_filter_frequency", "<i2"),
+    ("notch_filter_slope", "<i2"),
+    ("low_cut_frequency", "<i2"),
+    ("high_cut_frequency", "<i2"),
+    ("low_cut_slope", "<i2"),
+    ("high_cut_slope", "<i2"),
+    ("year_data_recorded", "<i2"),
+    ("day_of_year", "<i2"),
+    ("hour_of_day", "<i2"),
+    ("minute_of_hour", "<i2"),
+    ("second_of_minute", "<i2"),
+    ("time_basis_code", "<i2"),
+    ("trace_weighting_factor", "<i2"),
+    ("geophone_group_number_of_roll_switch_position_one", "<i2"),
+    ("geophone_group_number_of_trace_number_one", "<i2"),
+    ("geophone_group_number_of_last_trace", "<i2"),
+    ("gap_size", "<i2"),
+    ("over_travel_associated_with_taper", "<i2"),
+    ("x_coordinate_of_ensemble_position_of_this_trace", "<i4"),
+    ("y_coordinate_of_ensemble_position_of_this_trace", "<i4"),
+    ("for_3d_poststack_data_this_field_is_for_in_line_number", "<i4"),
+    ("for_3d_poststack_data_this_field_is_for_cross_line_number", "<i4"),
+    ("shotpoint_number", "<i4"),
+    ("scalar_to_be_applied_to_the_shotpoint_number", "<i2"),
+    ("trace_value_measurement_unit", "<i2"),
+    ("transduction_constant_mantissa", "<i4"),
+    ("transduction_constant_exponent", "<i2"),
+    ("transduction_units", "<i2"),
+    ("device_trace_identifier", "<i2"),
+    ("scalar_to_be_applied_to_times", "<i2"),
+    ("source_type_orientation", "<i2"),
+    ("source_energy_direction_mantissa", "<i4"),
+    ("source_energy_direction_exponent", "<i2"),
+    ("source_measurement_mantissa", "<i4"),
+    ("source_measurement_exponent", "<i2"),
+    ("source_measurement_unit", "<i2"),
+    ("unassigned", "V8"),
+])
+
+assert HEADER_DTYPE.itemsize == 240
+
+# SU stores the sample interval in microseconds as an unsigned short
+MAX_SAMPLE_INTERVAL = np.iinfo(np.uint16).max
+
+
+def trace_dtype(nt):
+    """
+    Structured dtype of a single SU trace: header followed by nt samples
+
+    :type nt: int
+    :param nt: number of samples per trace
+    :rtype: np.dtype
+    """
+    return np.dtype([("header", HEADER_DTYPE), ("data", "<f4", (nt,))])
+
+
+class RecordSection:
+    """
+    Traces of an SU file held as whole arrays: samples of shape (nrec, nt),
+    trace headers as a record array of shape (nrec,) and the sample interval
+    shared by all traces. Slicing selects a range of receivers and adding two
+    sections concatenates their receivers, as with an ObsPy Stream
+
+    :type data: np.ndarray
+    :param data: samples, shape (nrec, nt)
+    :type headers: np.recarray
+    :param headers: trace headers with dtype HEADER_DTYPE
+    :type delta: float
+    :param delta: sample interval in seconds
+    """
+    def __init__(self, data, headers, delta):
+        self.data = data
+        self.headers = headers
+        self.delta = delta
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getitem__(self, index):
+        return RecordSection(self.data[index], self.headers[index],
+                             self.delta)
+
+    def __add__(self, other):
+        return RecordSection(np.concatenate((self.data, other.data)),
+                             np.concatenate((self.headers, other.headers)
+                                            ).view(np.recarray),
+                             self.delta)
+
+
+def read(filename, mode="c"):
+    """
+    Memory maps an SU file. Both returned arrays are views of the same map,
+    so nothing is read from disk until it is accessed
+
+    :type filename: str
+    :param filename: SU file to read
+    :type mode: str
+    :param mode: numpy.memmap mode, by default copy-on-write so that changes
+        to the returned arrays are never written back to the file
+    :rtype: tuple (np.ndarray, np.recarray)
+    :return: samples, shape (nrec, nt), and trace headers, shape (nrec,)
+    """
+    nbytes = os.path.getsize(filename)
+    if nbytes < HEADER_DTYPE.itemsize:
+        raise ValueError(f"{filename} is not a Seismic Unix file")
+
+    # All traces written by Specfem share the number of samples
+    nt = int(np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+             ["number_of_samples_in_this_trace"][0])
+    dtype = trace_dtype(nt)
+
+    if nbytes % dtype.itemsize:
+        raise ValueError(f"{filename}: size {nbytes} is not a multiple of "
+                         f"the trace length {dtype.itemsize}")
+
+    traces = np.memmap(filename, dtype=dtype, mode=mode)
+
+    return traces["data"], traces["header"].view(np.recarray)
+
+
+def write(filename, data, headers, dt=None):
+    """
+    Writes an SU file from an (nrec, nt) array and a set of trace headers in
+    a single pass, e.g. adjoint traces that reuse the synthetic headers
+
+    :type filename: str
+    :param filename: SU file to write
+    :type data: np.ndarray
+    :param data: samples, shape (nrec, nt)
+    :type headers: np.ndarray
+    :param headers: trace headers with dtype HEADER_DTYPE, shape (nrec,)
+    :type dt: float
+    :param dt: optional sample interval in seconds; overwrites the interval
+        in the headers, clipped to the largest value SU can represent
+    """
+    data = np.atleast_2d(data)
+    nrec, nt = data.shape
+
+    traces = np.empty(nrec, dtype=trace_dtype(nt))
+    traces["header"] = headers
+    traces["data"] = data
+
+    traces["header"]["number_of_samples_in_this_trace"] = nt
+    if dt is not None:
+        traces["header"]["sample_interval_in_ms_for_this_trace"] = \
+            min(int(round(dt * 1e6)), MAX_SAMPLE_INTERVAL)
+
+    traces.tofile(filename)
@@ -1,6 +1,11 @@
 
+import os
 import numpy as np
 
+from scipy.fft import next_fast_len
+from scipy.signal import hilbert, resample_poly
+from scipy.signal.windows import dpss, hann
+
 
 ### functions acting on whole record sections
 
@@ -30,21 +35,9 @@ def mute_early_arrivals(traces, slope, const, time_scheme, s_coords, r_coords):
         CONST has units of time, and
         || s - r || is distance between source and receiver.
     """
-
-    nr = len(traces)
-    nt, dt, _ = time_scheme
-
-
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
-
-        # apply tapered mask
-        traces[ir].data *= mask(slope, const, offset, (nt, dt, 0.))
-
-    return traces
+    mask = mask_arrivals(slope, const, offsets(s_coords, r_coords),
+                         time_scheme)
+    return apply_mask(traces, mask)
 
 
 def mute_late_arrivals(traces, slope, const, time_scheme, s_coords, r_coords):
@@ -58,20 +51,9 @@ def mute_late_arrivals(traces, slope, const, time_scheme, s_coords, r_coords):
         CONST has units of time, and
         || s - r || is distance between source and receiver.
     """
-
-    nr = len(traces)
-    nt, dt, _ = time_scheme
-
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
-
-        # apply tapered mask
-        traces[ir].data *= (1.-mask(slope, const, offset, (nt, dt, 0.)))
-
-    return traces
+    mask = 1. - mask_arrivals(slope, const, offsets(s_coords, r_coords),
+                              time_scheme)
+    return apply_mask(traces, mask)
 
 
 def mute_short_offsets(traces, dist, s_coords, r_coords):
@@ -82,18 +64,8 @@ def mute_short_offsets(traces, dist, s_coords, r_coords):
         where || s - r || is the offset between source and receiver and 
         DIST is a user-supplied cutoff
     """
-    nr = len(traces)
-
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
-
-        if offset < dist:
-            traces[ir].data[:] = 0.
-        
-    return traces
+    mask = (offsets(s_coords, r_coords) >= dist)[:, None].astype(float)
+    return apply_mask(traces, mask)
 
 
 def mute_long_offsets(traces, dist, s_coords, r_coords):
@@ -104,20 +76,96 @@ def mute_long_offsets(traces, dist, s_coords, r_coords):
         where || s - r || is the offset between source and receiver and 
         DIST is a user-supplied cutoff
     """
-    nr = len(traces)
+    mask = (offsets(s_coords, r_coords) <= dist)[:, None].astype(float)
+    return apply_mask(traces, mask)
 
-    for ir in range(nr):
-        # calculate source-reciever distance
-        (sx, sy) = (s_coords[0][ir], s_coords[1][ir])
-        (rx, ry) = (r_coords[0][ir], r_coords[1][ir])
-        offset = np.sqrt((rx-sx)**2 + (ry-sy)**2)
 
-        if offset > dist:
-            traces[ir].data[:] = 0.
-        
+def mute_mask(offset, time_scheme, early=None, late=None, short_dist=None,
+              long_dist=None):
+    """ Builds a single (nrec, nt) mask combining early arrival, late arrival,
+      short offset and long offset mutes, so that a record section can be
+      muted with one multiplication.
+
+        `early` and `late` are (SLOPE, CONST) pairs, see mute_early_arrivals
+        and mute_late_arrivals; `short_dist` and `long_dist` are the cutoffs
+        of mute_short_offsets and mute_long_offsets. Mutes set to None are
+        not applied.
+    """
+    nt, _, _ = time_scheme
+    offset = np.asarray(offset, dtype=float)
+
+    mask = np.ones((len(offset), nt))
+    if early is not None:
+        mask *= mask_arrivals(*early, offset, time_scheme)
+    if late is not None:
+        mask *= 1. - mask_arrivals(*late, offset, time_scheme)
+    if short_dist is not None:
+        mask[offset < short_dist] = 0.
+    if long_dist is not None:
+        mask[offset > long_dist] = 0.
+
+    return mask
+
+
+def apply_mask(traces, mask):
+    """ Multiplies each trace of a record section by the corresponding row of
+      a (nrec, nt) mask, or (nrec, 1) for whole-trace mutes
+    """
+    data = np.array([tr.data for tr in traces])
+    data *= mask
+    for tr, row in zip(traces, data):
+        tr.data = row
+
     return traces
 
 
+def decimate(data, factor):
+    """ Downsamples a record section by an integer factor along the last
+      axis, after applying a zero-phase anti-aliasing lowpass filter.
+      Returns ceil(nt / factor) samples per trace.
+    """
+    if factor == 1:
+        return data
+    return resample_poly(data, 1, factor, axis=-1)
+
+
+def upsample(data, factor, nt):
+    """ Interpolates a decimated record section back to `nt` samples per
+      trace with the same family of zero-phase lowpass filters as decimate,
+      e.g. to bring adjoint sources measured at a decimated rate back to the
+      solver time step
+    """
+    if factor == 1:
+        return data
+    return resample_poly(data, factor, 1, axis=-1)[..., :nt]
+
+
+def taper(data, max_percentage=0.05):
+    """ Applies a Hann taper to both ends of every trace of a record section,
+      each end spanning `max_percentage` of the trace, as
+      obspy.Trace.taper(max_percentage, type="hann")
+    """
+    npts = data.shape[-1]
+    wlen = min(int(max_percentage * npts), int(npts / 2))
+    sides = hann(2 * wlen if 2 * wlen == npts else 2 * wlen + 1)
+
+    window = np.ones(npts)
+    window[:wlen] = sides[:wlen]
+    window[npts - wlen:] = sides[len(sides) - wlen:]
+
+    return data * window
+
+
+def offsets(s_coords, r_coords):
+    """ Horizontal source-receiver distances || s - r || for each receiver,
+      from (x, y, z) coordinate lists as returned by the PREPROCESS class
+    """
+    sx, sy = np.asarray(s_coords[0], float), np.asarray(s_coords[1], float)
+    rx, ry = np.asarray(r_coords[0], float), np.asarray(r_coords[1], float)
+
+    return np.sqrt((rx-sx)**2 + (ry-sy)**2)
+
+
 
 ### functions acting on individual traces
 
@@ -125,37 +173,97 @@ def mask(slope, const, offset, time_scheme, length=400):
     """ Constructs tapered mask that can be applied to trace to
       mute early or late arrivals.
     """
+    return mask_arrivals(slope, const, [offset], time_scheme, length)[0]
 
-    nt, dt, _ = time_scheme
 
-    mask = np.ones(nt)
+def mask_arrivals(slope, const, offsets, time_scheme, length=400):
+    """ Constructs tapered masks for all receivers of a record section at
+      once, by broadcasting sample indices against per-receiver onsets.
+
+        Each row is zero before the onset, rises along a sine taper of
+        `length` samples centered on SLOPE * offset + CONST and is one
+        afterwards. Returns an array of shape (len(offsets), nt).
+    """
+    nt, dt, _ = time_scheme
 
     # construct taper
     win = np.sin(np.linspace(0, np.pi, 2*length))
     win = win[0:length]
 
-    # caculate offsets
-    itmin = int(np.ceil((slope*abs(offset)+const)/dt)) - length/2
-    itmax = itmin + length
-
-    if 1 < itmin < itmax < nt:
-        mask[0:itmin] = 0.
-        mask[itmin:itmax] = win*mask[itmin:itmax]
-    elif itmin < 1 <= itmax:
-        mask[0:itmax] = win[length-itmax:length]*mask[0:itmax]
-    elif itmin < nt < itmax:
-        mask[0:itmin] = 0.
-        mask[itmin:nt] = win[0:nt-itmin]*mask[itmin:nt]
-    elif itmin > nt:
-        mask[:] = 0.
+    # calculate onsets
+    offsets = np.abs(np.asarray(offsets, dtype=float))
+    itmin = np.ceil((slope*offsets + const)/dt).astype(int) - length//2
 
-    return mask
+    # position of each sample relative to the start of each taper
+    it = np.arange(nt)[None, :] - itmin[:, None]
+
+    return np.where(it < 0, 0., np.where(it >= length, 1.,
+                                         win[np.clip(it, 0, length - 1)]))
 
 
 
-def correlate(u, v):
-    w = np.convolve(u, np.flipud(v))
-    return
+def correlate(u, v, U=None):
+    """ Cross-correlates `u` with `v` along the last axis using FFTs
+
+        Equivalent to np.convolve(u, np.flipud(v)) for 1D traces, so that
+        index len(v) - 1 corresponds to zero lag, but O(nt log nt) rather
+        than O(nt**2). 2D (nrec, nt) record sections are correlated row by row
+        in a single batched transform. `U` optionally holds the spectrum of
+        `u` padded to next_fast_len(len(u) + len(v) - 1), e.g. from
+        ObservedSpectra, so that it is not transformed again.
+    """
+    n = u.shape[-1] + v.shape[-1] - 1
+    nfft = next_fast_len(n)
+
+    if U is None:
+        U = np.fft.rfft(u, nfft)
+
+    # zero padding to nfft >= n avoids wrap-around of the circular correlation
+    cc = np.fft.irfft(U * np.fft.rfft(np.flip(v, axis=-1), nfft), nfft)
+    return cc[..., :n]
+
+
+def cc_shift(u, v, dt, U=None):
+    """ Time shift of `u` relative to `v` that maximizes the absolute value of
+      their cross-correlation, refined to sub-sample precision by fitting a
+      parabola through the correlation peak and its two neighbours.
+
+        A positive shift means that `u` is delayed with respect to `v`.
+        Works on single traces or batched on (nrec, nt) record sections.
+        Returns the time shift(s) and the interpolated peak value(s) of the
+        absolute cross-correlation. `U` is an optional precomputed spectrum
+        of `u`, see correlate.
+    """
+    return cc_peak(correlate(u, v, U), v.shape[-1], dt)
+
+
+def cc_peak(cc, nv, dt):
+    """ Lag and interpolated value of the peak of the absolute value of
+      cross-correlation(s) `cc` laid out as returned by correlate, where `nv`
+      is the length of the second (reference) trace. See cc_shift.
+    """
+    cc = np.abs(cc)
+    ncc = cc.shape[-1]
+
+    imax = np.argmax(cc, axis=-1)[..., None]
+    ileft = np.clip(imax - 1, 0, ncc - 1)
+    iright = np.clip(imax + 1, 0, ncc - 1)
+
+    y0 = np.take_along_axis(cc, ileft, axis=-1)[..., 0]
+    y1 = np.take_along_axis(cc, imax, axis=-1)[..., 0]
+    y2 = np.take_along_axis(cc, iright, axis=-1)[..., 0]
+    imax = imax[..., 0]
+
+    # vertex of parabola through (-1, y0), (0, y1), (1, y2), skipped if the
+    # peak sits on either end of the correlation or the points are collinear
+    denom = y0 - 2.*y1 + y2
+    interior = (0 < imax) & (imax < ncc - 1) & (denom < 0.)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        delta = np.where(interior, 0.5 * (y0 - y2) / denom, 0.)
+    ccmax = y1 - 0.25 * (y0 - y2) * delta
+
+    shift = (imax + delta - (nv - 1)) * dt
+    return shift, ccmax
 
 
 def tukeywin(nt, imin, imax, alpha=0.05):
@@ -171,3 +279,79 @@ def tukeywin(nt, imin, imax, alpha=0.05):
     win[imin:imax] = w
     return win
 
+
+
+### cached transforms of observed data
+
+class ObservedSpectra:
+    """ Transforms of a fixed (nrec, nt) record section, e.g. processed
+      observed data, which do not change during an inversion.
+
+        Quantities are computed on first access. Those that require FFTs
+        (analytic signal, padded spectra, multitaper spectra) are also saved
+        as '<prefix>_<name>.npy' when a prefix is given and memory mapped on
+        later evaluations; envelope and instantaneous phase are cheap to
+        derive from the analytic signal and are only held in memory.
+        Spectra are one-sided (rfft) and padded to `nfft`, the length used by
+        correlate() for traces of equal length, so they can be passed to
+        correlate() and cc_shift() as `U`.
+    """
+    def __init__(self, data, prefix=None):
+        self.data = data
+        self.prefix = prefix
+        self.nfft = next_fast_len(2 * data.shape[-1] - 1)
+        self._cache = {}
+
+    @property
+    def analytic(self):
+        return self._get("analytic", lambda: hilbert(self.data, axis=-1))
+
+    @property
+    def envelope(self):
+        return self._get("envelope", lambda: np.abs(self.analytic),
+                         save=False)
+
+    @property
+    def phase(self):
+        return self._get("phase", lambda: np.arctan2(np.imag(self.analytic),
+                                                     np.real(self.analytic)),
+                         save=False)
+
+    @property
+    def fft(self):
+        return self._get("fft", lambda: np.fft.rfft(self.data, self.nfft))
+
+    @property
+    def envelope_fft(self):
+        return self._get("envelope_fft",
+                         lambda: np.fft.rfft(self.envelope, self.nfft))
+
+    def multitaper(self, nw=4., ntaper=None):
+        """ Spectra of the record section multiplied by each of `ntaper`
+          discrete prolate spheroidal sequences of time-halfbandwidth `nw`
+          (default 2 * nw - 1 tapers), shape (nrec, ntaper, nfft // 2 + 1)
+        """
+        ntaper = ntaper or int(2 * nw) - 1
+
+        def func():
+            tapers = dpss(self.data.shape[-1], nw, ntaper)
+            return np.fft.rfft(self.data[..., None, :] * tapers, self.nfft)
+
+        return self._get(f"multitaper_{nw:g}_{ntaper:d}", func)
+
+    def _get(self, name, func, save=True):
+        if name not in self._cache:
+            filename = f"{self.prefix}_{name}.npy" if self.prefix else None
+            if save and filename and os.path.exists(filename):
+                self._cache[name] = np.load(filename, mmap_mode="r")
+            else:
+                self._cache[name] = func()
+                if save and filename:
+                    # written to a temporary file first so that a partially
+                    # written file is never read by another process
+                    tmpfile = f"{filename}.{os.getpid()}.tmp"
+                    with open(tmpfile, "wb") as f:
+                        np.save(f, self._cache[name])
+                    os.replace(tmpfile, filename)
+
+        return self._cache[name]
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+"""
+Native Gaussian smoothing of models and kernels defined on the GLL points of
+SPECFEM meshes, used in place of SPECFEM's xsmooth_sem
+
+Each output value is the Gaussian weighted average of all input values within
+about three standard deviations, found with KD-tree neighbor queries over the
+points of a slice and of all slices within reach of it, its halo, so that
+smoothing is continuous across slice boundaries. Slices can therefore also be
+smoothed in subsets, e.g. by separate tasks. Because the mesh is fixed
+throughout an inversion, the normalized weights are computed once per mesh
+and smoothing length, cached to disk as one sparse matrix per slice, and
+every later smoothing is a sparse matrix-vector product per slice and
+parameter.
+
+Note:
+    Unlike xsmooth_sem, points are not weighted by their GLL quadrature
+    weights and Jacobians, which are not written to the model databases.
+    Coordinates are treated as Cartesian: x (and y) horizontal, z vertical
+"""
+import os
+import hashlib
+import multiprocessing
+import numpy as np
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix, load_npz, save_npz
+
+from seisflows.plugins.solver_io import fortran_binary
+
+# Neighbors are truncated at this many standard deviations
+TRUNCATE = 3.
+
+# Number of points for which neighbors are found at once, bounds memory use
+CHUNK_SIZE = 2**14
+
+# Smoother and field currently in use, inherited by forked worker processes
+_STATE = {}
+
+
+class GaussianSmoother:
+    """
+    Anisotropic Gaussian smoothing operator on the GLL points of a mesh
+    """
+    def __init__(self, path, span_h, span_v=0., cache=None, nproc=1,
+                 chunk_size=CHUNK_SIZE):
+        """
+        :type path: str
+        :param path: path to the model databases containing the coordinate
+            slices `procXXXXXX_x.bin`, `procXXXXXX_z.bin` and, for 3D meshes,
+            `procXXXXXX_y.bin`
+        :type span_h: float
+        :param span_h: Gaussian standard deviation in the horizontal
+        :type span_v: float
+        :param span_v: Gaussian standard deviation in the vertical, if not
+            positive smoothing is isotropic with span_h
+        :type cache: str
+        :param cache: optional directory to cache smoothing weights in
+        :type nproc: int
+        :param nproc: number of slices to process in parallel
+        :type chunk_size: int
+        :param chunk_size: number of points for which to query neighbors at
+            once
+        """
+        if span_h <= 0:
+            raise ValueError("Horizontal smoothing length must be positive")
+
+        self.path = path
+        self.span_h = float(span_h)
+        self.span_v = float(span_v) if span_v > 0 else float(span_h)
+        self.nproc = max(1, int(nproc))
+        self.chunk_size = chunk_size
+
+        self.nslice = len(glob(os.path.join(path, "proc??????_x.bin")))
+        if not self.nslice:
+            raise FileNotFoundError(f"No mesh coordinates found in {path}")
+
+        if os.path.exists(os.path.join(path, "proc000000_y.bin")):
+            self.coords = ["x", "y", "z"]
+        else:
+            self.coords = ["x", "z"]
+
+        self.cache = None
+        if cache:
+            self.cache = os.path.join(cache, self.key)
+
+        self._points = None
+        self._columns = None
+        self._start = None
+        self._tree = None
+        self._offsets = None
+        self._bounds = None
+        self._weights = {}
+
+    @property
+    def key(self):
+        """
+        Identifies the mesh and smoothing lengths that weights are cached for
+
+        :rtype: str
+        :return: hash of the coordinate files and smoothing lengths
+        """
+        sha = hashlib.sha1(f"{self.span_h} {self.span_v}".encode())
+        for iproc in range(self.nslice):
+            for key in self.coords:
+                stat = os.stat(os.path.join(self.path,
+                                            f"proc{iproc:06d}_{key}.bin"))
+                sha.update(f"{stat.st_size} {stat.st_mtime_ns}".encode())
+        return sha.hexdigest()
+
+    @property
+    def offsets(self):
+        """
+        Index of the first point of each slice in the concatenated mesh
+
+        :rtype: np.array
+        :return: offsets of all slices, and the total number of points
+        """
+        if self._offsets is None:
+            ngll = [fortran_binary.map_slice(self.path, "x", iproc)[0].size
+                    for iproc in range(self.nslice)]
+            self._offsets = np.concatenate(([0], np.cumsum(ngll)))
+        return self._offsets
+
+    @property
+    def bounds(self):
+        """
+        Bounding boxes of all slices, in coordinates scaled by the smoothing
+        lengths, used to find the slices that smoothing a slice depends on
+
+        :rtype: np.array
+        :return: (nslice, 2, ndim) minimum and maximum coordinates of slices
+        """
+        if self._bounds is None:
+            filename = None
+            if self.cache:
+                filename = os.path.join(self.cache, "bounds.npy")
+                if os.path.exists(filename):
+                    self._bounds = np.load(filename)
+                    return self._bounds
+
+            bounds = []
+            for iproc in range(self.nslice):
+                points = self._scaled(iproc)
+                bounds.append([points.min(axis=0), points.max(axis=0)])
+            self._bounds = np.array(bounds)
+
+            if filename:
+                os.makedirs(self.cache, exist_ok=True)
+                tmp = f"{filename[:-4]}.{os.getpid()}.tmp.npy"
+                np.save(tmp, self._bounds)
+                os.replace(tmp, filename)
+
+        return self._bounds
+
+    def halo(self, slices):
+        """
+        Finds the slices containing points within the truncation radius of
+        the given slices, i.e. the given slices and their halo
+
+        :type slices: list
+        :param slices: slice numbers
+        :rtype: list
+        :return: sorted slice numbers that smoothing the slices depends on
+        """
+        bounds = self.bounds
+        halo = np.zeros(self.nslice, dtype=bool)
+        for iproc in slices:
+            gap = np.maximum(0., np.maximum(bounds[:, 0] - bounds[iproc, 1],
+                                            bounds[iproc, 0] - bounds[:, 1]))
+            halo |= np.sum(gap ** 2, axis=1) <= TRUNCATE ** 2
+        return [int(iproc) for iproc in np.flatnonzero(halo)]
+
+    def setup(self, slices=None):
+        """
+        Computes the smoothing weights of the given slices that are not
+        cached, in parallel over slices. Only the slices and their halo are
+        read, so that shards of a large mesh can be set up independently
+
+        :type slices: list
+        :param slices: slice numbers, defaults to all slices
+        """
+        if slices is None:
+            slices = range(self.nslice)
+
+        missing = [iproc for iproc in slices if not self._cached(iproc)]
+        if not missing:
+            return
+
+        # Scale coordinates by the smoothing lengths, which turns anisotropic
+        # smoothing into isotropic smoothing with unit standard deviation
+        halo = self.halo(missing)
+        self._points = np.concatenate([self._scaled(iproc) for iproc in halo])
+        self._columns = self._columns_of(halo)
+        self._start = dict(zip(halo, np.searchsorted(
+            self._columns, self.offsets[halo])))
+        self._tree = cKDTree(self._points)
+
+        weights = self._map(_weights_slice, missing)
+
+        # Without a cache directory weights are only kept in memory
+        if not self.cache:
+            self._weights.update(zip(missing, weights))
+
+        self._points = None
+        self._columns = None
+        self._start = None
+        self._tree = None
+
+    def smooth(self, input_path, output_path, parameters, suffix="",
+               slices=None):
+        """
+        Smooths model or kernel slices, writing the results in the same
+        Fortran binary format
+
+        :type input_path: str
+        :param input_path: directory to read slices from
+        :type output_path: str
+        :param output_path: directory to write smoothed slices to
+        :type parameters: list
+        :param parameters: material parameters e.g. ['vp','vs']
+        :type suffix: str
+        :param suffix: suffix of the file names e.g. '_kernel'
+        :type slices: list
+        :param slices: slice numbers to smooth, defaults to all slices. Input
+            slices are read for these slices and their halo
+        """
+        if slices is None:
+            slices = range(self.nslice)
+        slices = list(slices)
+
+        self.setup(slices)
+        os.makedirs(output_path, exist_ok=True)
+
+        halo = self.halo(slices)
+        columns = None
+        if len(halo) < self.nslice:
+            columns = self._columns_of(halo)
+
+        for par in parameters:
+            field = np.concatenate(
+                [fortran_binary.read_slice(input_path, f"{par}{suffix}",
+                                           iproc)[0]
+                 for iproc in halo]).astype("float64")
+
+            outputs = self._map(_smooth_slice, slices, field=field,
+                                columns=columns)
+            for iproc, values in zip(slices, outputs):
+                fortran_binary.write_slice(values, output_path,
+                                           f"{par}{suffix}", iproc)
+
+    def weights(self, iproc):
+        """
+        Row normalized smoothing weights of one slice, which map values on all
+        points of the mesh to the points of the slice
+
+        :type iproc: int
+        :param iproc: slice number
+        :rtype: scipy.sparse.csr_matrix
+        :return: smoothing weights of the slice
+        """
+        weights = self._read_weights(iproc)
+        if weights is not None:
+            return weights
+
+        start = self._start[iproc]
+        ngll = self.offsets[iproc + 1] - self.offsets[iproc]
+        rows, cols, dist = [], [], []
+        for i0 in range(start, start + ngll, self.chunk_size):
+            i1 = min(i0 + self.chunk_size, start + ngll)
+            pairs = cKDTree(self._points[i0:i1]).sparse_distance_matrix(
+                self._tree, max_distance=TRUNCATE, output_type="ndarray")
+            rows.append(pairs["i"] + (i0 - start))
+            cols.append(self._columns[pairs["j"]])
+            dist.append(pairs["v"])
+
+        rows = np.concatenate(rows)
+        values = np.exp(-0.5 * np.concatenate(dist)**2)
+        values /= np.bincount(rows, values, minlength=ngll)[rows]
+
+        weights = csr_matrix((values.astype("float32"),
+                              (rows, np.concatenate(cols))),
+                             shape=(ngll, self.offsets[-1]))
+
+        if self.cache:
+            os.makedirs(self.cache, exist_ok=True)
+            filename = self._weights_file(iproc)
+            tmp = f"{filename[:-4]}.{os.getpid()}.tmp.npz"
+            save_npz(tmp, weights)
+            os.replace(tmp, filename)
+
+        return weights
+
+    def _scaled(self, iproc):
+        """
+        Coordinates of one slice divided by the smoothing lengths
+        """
+        points = []
+        for key in self.coords:
+            span = self.span_v if key == "z" else self.span_h
+            points.append(
+                fortran_binary.read_slice(self.path, key, iproc)[0] / span)
+        return np.column_stack(points)
+
+    def _columns_of(self, slices):
+        """
+        Indices of the points of slices in the concatenated mesh
+        """
+        return np.concatenate([np.arange(self.offsets[iproc],
+                                         self.offsets[iproc + 1])
+                               for iproc in slices])
+
+    def _weights_file(self, iproc):
+        """
+        Cache file of the smoothing weights of one slice
+        """
+        return os.path.join(self.cache, f"proc{iproc:06d}_weights.npz")
+
+    def _cached(self, iproc):
+        """
+        Whether the smoothing weights of one slice have been computed
+        """
+        return iproc in self._weights or bool(
+            self.cache and os.path.exists(self._weights_file(iproc)))
+
+    def _read_weights(self, iproc):
+        """
+        Reads cached smoothing weights of one slice, if available
+        """
+        if iproc in self._weights:
+            return self._weights[iproc]
+        if self.cache and os.path.exists(self._weights_file(iproc)):
+            return load_npz(self._weights_file(iproc))
+        return None
+
+    def _map(self, func, slices, **kwargs):
+        """
+        Applies func to slices in a pool of forked worker processes, which
+        inherit the smoother and any other state from this process
+        """
+        _STATE.update(smoother=self, **kwargs)
+        try:
+            nproc = min(self.nproc, len(slices), os.cpu_count() or 1)
+            if nproc > 1:
+                ctx = multiprocessing.get_context("fork")
+                with ProcessPoolExecutor(max_workers=nproc,
+                                         mp_context=ctx) as pool:
+                    return list(pool.map(func, slices))
+            else:
+                return [func(iproc) for iproc in slices]
+        finally:
+            _STATE.clear()
+
+
+def _weights_slice(iproc):
+    """
+    Computes and caches the smoothing weights of one slice
+    """
+    weights = _STATE["smoother"].weights(iproc)
+    if not _STATE["smoother"].cache:
+        return weights
+
+
+def _smooth_slice(iproc):
+    """
+    Smooths the current field onto the points of one slice
+    """
+    weights = _STATE["smoother"].weights(iproc)
+    if _STATE["columns"] is not None:
+        weights = weights[:, _STATE["columns"]]
+    return weights @ _STATE["field"]
@@ -311,6 +311,19 @@ def nproc():
         return _nproc_method2()
 
 
+def cores():
+    """
+    Get the number of cores this process may run on, which under a batch
+    scheduler is the job's allocation rather than every core of the node
+
+    :rtype: int
+    :return: number of cores
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def _nproc_method1():
     """
     Used subprocess to determine the number of processeors available
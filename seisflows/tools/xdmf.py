@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Exports models, gradients and kernels for visualization, as a native
+replacement for SPECFEM's xcombine_vol_data_vtk
+
+Values and coordinates of the GLL points of each slice are written as raw
+little endian float32 files, described by an XDMF file which ParaView and
+VisIt read directly. Slices are streamed one at a time and written in
+parallel, and GLL points can be decimated to reduce file sizes. Points are
+exported as a point cloud, i.e. a Polyvertex topology, as element
+connectivity is not written to the model databases
+"""
+import os
+import multiprocessing
+import numpy as np
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
+from seisflows.plugins.solver_io import fortran_binary
+from seisflows.tools.tools import cores
+
+SLICE = """\
+   <Grid Name="proc{iproc:06d}" GridType="Uniform">
+    <Topology TopologyType="Polyvertex" NumberOfElements="{npts}" NodesPerElement="1"/>
+    <Geometry GeometryType="{geometry}">
+     <DataItem Format="Binary" NumberType="Float" Precision="4" Endian="Little" Dimensions="{npts} {ndim}">{coords}</DataItem>
+    </Geometry>
+{attributes}   </Grid>
+"""
+
+ATTRIBUTE = """\
+    <Attribute Name="{name}" AttributeType="Scalar" Center="Node">
+     <DataItem Format="Binary" NumberType="Float" Precision="4" Endian="Little" Dimensions="{npts}">{values}</DataItem>
+    </Attribute>
+"""
+
+
+def write(input_path, output_path, parameters, coords_path, suffix="",
+          name="model", decimate=1, nproc=1, geometry_path=None):
+    """
+    Writes slices of a model, gradient or kernels as raw float32 files and an
+    XDMF file `<output_path>/<name>.xdmf` describing them
+
+    :type input_path: str
+    :param input_path: directory containing the slices to export
+    :type output_path: str
+    :param output_path: directory to write the XDMF and value files to
+    :type parameters: list
+    :param parameters: material parameters e.g. ['vp','vs']
+    :type coords_path: str
+    :param coords_path: directory containing the coordinate slices
+        `procXXXXXX_x.bin`, `procXXXXXX_z.bin` and, for 3D meshes,
+        `procXXXXXX_y.bin`
+    :type suffix: str
+    :param suffix: suffix of the file names e.g. '_kernel'
+    :type name: str
+    :param name: name of the XDMF file and prefix of the raw value files
+    :type decimate: int
+    :param decimate: export every `decimate`th GLL point
+    :type nproc: int
+    :param nproc: number of slices to write in parallel
+    :type geometry_path: str
+    :param geometry_path: directory to write coordinates to, which are reused
+        by later exports of the same mesh that share the directory, e.g. one
+        export per iteration. The XDMF file refers to them by relative path.
+        Defaults to `output_path`
+    :rtype: str
+    :return: path of the XDMF file
+    """
+    if geometry_path is None:
+        geometry_path = output_path
+    os.makedirs(output_path, exist_ok=True)
+    os.makedirs(geometry_path, exist_ok=True)
+
+    nslice = len(glob(os.path.join(coords_path, "proc??????_x.bin")))
+    if os.path.exists(os.path.join(coords_path, "proc000000_y.bin")):
+        coords = ["x", "y", "z"]
+    else:
+        coords = ["x", "z"]
+
+    tasks = [(input_path, output_path, geometry_path, parameters, coords_path,
+              coords, suffix, name, decimate, iproc)
+             for iproc in range(nslice)]
+
+    # Exports run on the master job, limited to the cores allocated to it
+    nproc = min(nproc, nslice, cores())
+    if nproc > 1:
+        with ProcessPoolExecutor(
+                max_workers=nproc,
+                mp_context=multiprocessing.get_context("fork")) as pool:
+            grids = list(pool.map(_write_slice, tasks))
+    else:
+        grids = [_write_slice(args) for args in tasks]
+
+    filename = os.path.join(output_path, f"{name}.xdmf")
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" ?>\n'
+                '<Xdmf Version="2.0">\n'
+                ' <Domain>\n'
+                f'  <Grid Name="{name}" GridType="Collection" '
+                'CollectionType="Spatial">\n')
+        f.writelines(grids)
+        f.write('  </Grid>\n'
+                ' </Domain>\n'
+                '</Xdmf>\n')
+
+    return filename
+
+
+def _write_slice(args):
+    """
+    Writes the coordinates and values of one slice, see write. Module level
+    so that it can be dispatched to a process pool
+
+    :rtype: str
+    :return: XDMF description of the slice
+    """
+    (input_path, output_path, geometry_path, parameters, coords_path, coords,
+     suffix, name, decimate, iproc) = args
+
+    # Coordinates are only written once for each mesh
+    xyz = [fortran_binary.map_slice(coords_path, key, iproc)[0][::decimate]
+           for key in coords]
+    npts = len(xyz[0])
+    filename = os.path.join(
+        geometry_path, f"proc{iproc:06d}_{''.join(coords)}_{decimate}.raw")
+    coords_file = os.path.relpath(filename, output_path)
+    mtime = max(os.path.getmtime(os.path.join(coords_path,
+                                              f"proc{iproc:06d}_{key}.bin"))
+                for key in coords)
+    if not os.path.exists(filename) or os.path.getmtime(filename) < mtime:
+        _tofile(np.column_stack(xyz), filename)
+
+    attributes = ""
+    for par in parameters:
+        values = fortran_binary.map_slice(input_path, f"{par}{suffix}",
+                                          iproc)[0][::decimate]
+        values_file = f"proc{iproc:06d}_{name}_{par}.raw"
+        _tofile(values, os.path.join(output_path, values_file))
+        attributes += ATTRIBUTE.format(name=par, npts=npts, values=values_file)
+
+    return SLICE.format(iproc=iproc, npts=npts, ndim=len(coords),
+                        geometry="XYZ" if len(coords) == 3 else "XY",
+                        coords=coords_file, attributes=attributes)
+
+
+def _tofile(values, filename):
+    """
+    Writes values as raw little endian float32, replacing the file atomically
+    """
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    values.astype("<f4").tofile(tmp)
+    os.replace(tmp, filename)
@@ -104,6 +104,12 @@ class Inversion(custom_import("workflow", "base")):
         if "SAVERESIDUALS" not in PAR:
             setattr(PAR, "SAVERESIDUALS", False)
 
+        if "SAVEXDMF" not in PAR:
+            setattr(PAR, "SAVEXDMF", False)
+
+        if "XDMF_DECIMATE" not in PAR:
+            setattr(PAR, "XDMF_DECIMATE", 1)
+
         # Print statement outputs
         if "VERBOSE" not in PAR:
             setattr(PAR, "VERBOSE", True)
@@ -300,6 +306,9 @@ class Inversion(custom_import("workflow", "base")):
         preprocess.finalize()
 
         # Save files from scratch before discarding
+        if PAR.SAVEXDMF:
+            self.save_xdmf()
+
         if PAR.SAVEMODEL:
             self.save_model()
 
@@ -409,6 +418,24 @@ class Inversion(custom_import("workflow", "base")):
         if PAR.SAVEAS in ["vector", "both"]:
             np.save(file=dst, arr=optimize.load(src))
 
+    def save_xdmf(self):
+        """
+        Export the model and gradient of the current iteration as binary XDMF
+        for visualization in e.g. ParaView. Mesh coordinates are written once
+        to OUTPUT/xdmf and shared by the exports of all iterations
+        """
+        dst = os.path.join(PATH.OUTPUT, f"xdmf_{optimize.iter:04d}")
+        geometry = os.path.join(PATH.OUTPUT, "xdmf")
+
+        solver.combine_vol_data(input_path=os.path.join(PATH.GRAD, "model"),
+                                output_path=dst, name="model",
+                                decimate=PAR.XDMF_DECIMATE,
+                                geometry_path=geometry)
+        solver.combine_vol_data(input_path=os.path.join(PATH.GRAD, "gradient"),
+                                output_path=dst, suffix="_kernel",
+                                name="gradient", decimate=PAR.XDMF_DECIMATE,
+                                geometry_path=geometry)
+
     def save_kernels(self):
         """
         Save the kernel vector as a Fortran binary file on disk